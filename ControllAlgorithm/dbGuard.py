@@ -0,0 +1,75 @@
+"""
+Circuit breaker around Influxdb access of SmartBoiler control algorithm. After several consecutive failed requests
+the circuit opens and requests fail immediately until reset timeout passes, then one trial request is let through.
+
+author: J.Mitura (xmitur01)
+version: 1.0
+"""
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling database while circuit breaker is open."""
+
+
+class GuardedClient:
+    """Wrapper of InfluxDBClient passing query and write_points calls through circuit breaker.
+
+    :param client: InfluxDBClient object, should be created with timeout set
+    :param failure_threshold: int number of consecutive failures which opens the circuit
+    :param reset_timeout: float seconds after which open circuit lets trial request through
+    """
+
+    def __init__(self, client, failure_threshold=3, reset_timeout=60):
+        self.client = client
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def isOpen(self):
+        """Check if requests are rejected right now.
+
+        :return: bool True when circuit is open and reset timeout didn't pass yet
+        """
+        with self.lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def call(self, func, *args, **kwargs):
+        """Call database function through circuit breaker.
+
+        :param func: bound method of InfluxDBClient
+        :return: result of func
+        """
+        with self.lock:
+            if self.opened_at is not None:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError("Influxdb circuit open after %d failures" % self.failures)
+                self.opened_at = time.monotonic()  # half open, let this request through and block others
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    if self.opened_at is None:
+                        print("Influxdb unavailable, circuit opened.")
+                    self.opened_at = time.monotonic()
+            raise
+
+        with self.lock:
+            if self.opened_at is not None:
+                print("Influxdb available again, circuit closed.")
+            self.failures = 0
+            self.opened_at = None
+
+        return result
+
+    def query(self, *args, **kwargs):
+        return self.call(self.client.query, *args, **kwargs)
+
+    def write_points(self, *args, **kwargs):
+        return self.call(self.client.write_points, *args, **kwargs)
@@ -0,0 +1,211 @@
+"""
+Energy accounting of SmartBoiler. Joins plug power series published by HS110/energyUsage.py with switching log written
+by control algorithm and integrates consumed energy per heating window, per day and per plan type.
+Data are processed one day at a time, so backfill of any period runs in bounded memory.
+
+Usage: python3 energyReport.py [first day YYYY-MM-DD [last day YYYY-MM-DD]], days are UTC days, the last
+day which ended in UTC is processed by default.
+
+author: J.Mitura (xmitur01)
+version: 1.0
+"""
+import sys
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import plugState
+
+
+# DB queries and operations
+def queryPowerForDay(db, day):
+    """Query Influxdb for boiler plug power data of given day, other plugs publish power too.
+
+    :param db: InfluxDBClient object
+    :param day: string date YYYY-MM-DD
+    :return: tuple[array of epoch seconds, array of power values in W]
+    """
+    date_val = {'start_time': day + 'T00:00:00Z', 'end_time': day + 'T23:59:59Z', 'site': plugState.power_site}
+    res = db.query('SELECT "value" FROM power WHERE time >= $start_time AND time <= $end_time AND "site" = $site',
+                   bind_params=date_val, epoch='s')
+
+    times = []
+    values = []
+    for point in res.get_points():
+        times.append(point['time'])
+        values.append(point['value'])
+
+    return np.array(times, dtype=float), np.array(values, dtype=float)
+
+
+def querySwitchingForDay(db, day):
+    """Query Influxdb for executed plug switching of given day and for last switching before the day.
+
+    :param db: InfluxDBClient object
+    :param day: string date YYYY-MM-DD
+    :return: list of tuples[int epoch seconds, int state 1/0, string plan], oldest first
+    """
+    date_val = {'start_time': day + 'T00:00:00Z', 'end_time': day + 'T23:59:59Z'}
+    res_prev = db.query('SELECT last("value") AS "value", "plan" FROM plug_switch WHERE time < $start_time',
+                        bind_params=date_val, epoch='s')
+    res_day = db.query('SELECT "value", "plan" FROM plug_switch WHERE time >= $start_time AND time <= $end_time',
+                       bind_params=date_val, epoch='s')
+
+    switching = []
+    for point in list(res_prev.get_points()) + list(res_day.get_points()):
+        switching.append((int(point['time']), int(point['value']), point['plan']))
+
+    return switching
+
+
+def writeSummary(db, day, windows, window_energy, idle_energy):
+    """Write energy of heating windows and daily summary per plan type to Influxdb.
+
+    :param db: InfluxDBClient object
+    :param day: string date YYYY-MM-DD
+    :param windows: list of tuples[start epoch seconds, end epoch seconds, plan]
+    :param window_energy: array of energy in kWh for each window
+    :param idle_energy: float energy in kWh consumed outside of heating windows
+    """
+    points = []
+    daily = {'idle': [idle_energy, 0, 0.0]}  # plan: [kWh, windows, minutes]
+
+    for (start, end, plan), kwh in zip(windows, window_energy):
+        minutes = (end - start) / 60
+        points.append({'measurement': 'energy_window', 'tags': {'plan': plan}, 'time': int(start),
+                       'fields': {'kwh': round(float(kwh), 4), 'minutes': round(minutes, 1)}})
+
+        summary = daily.setdefault(plan, [0.0, 0, 0.0])
+        summary[0] += float(kwh)
+        summary[1] += 1
+        summary[2] += minutes
+
+    day_start = dayToEpoch(day)
+    for plan, (kwh, count, minutes) in daily.items():
+        points.append({'measurement': 'energy_daily', 'tags': {'plan': plan}, 'time': day_start,
+                       'fields': {'kwh': round(kwh, 4), 'windows': count, 'minutes': round(minutes, 1)}})
+
+    db.write_points(points, time_precision='s')
+
+
+# Calculations
+def dayToEpoch(day):
+    """Convert date to epoch seconds of its midnight(UTC).
+
+    :param day: string date YYYY-MM-DD
+    :return: int epoch seconds
+    """
+    return int((datetime.strptime(day, '%Y-%m-%d') - datetime(1970, 1, 1)).total_seconds())
+
+
+def heatingWindows(switching, day_start, day_end):
+    """Build heating windows from switching log, windows are cut on day borders.
+
+    :param switching: list of tuples[int epoch seconds, int state 1/0, string plan], oldest first
+    :param day_start: int epoch seconds of day start
+    :param day_end: int epoch seconds of day end
+    :return: list of tuples[start epoch seconds, end epoch seconds, plan]
+    """
+    windows = []
+    on_since = None
+    on_plan = None
+
+    for t, state, plan in switching:
+        t = max(t, day_start)
+        if state and on_since is None:
+            on_since, on_plan = t, plan
+        elif not state and on_since is not None:
+            if t > on_since:
+                windows.append((on_since, t, on_plan))
+            on_since = None
+
+    if on_since is not None and day_end > on_since:
+        windows.append((on_since, day_end, on_plan))
+
+    return windows
+
+
+def integrateEnergy(times, power, windows, max_gap=60):
+    """Integrate power series(trapezoidal rule) and assign energy of each sample interval to heating window
+    it belongs to. Intervals longer than max_gap are treated as missing data.
+
+    :param times: array of epoch seconds, sorted
+    :param power: array of power values in W
+    :param windows: list of tuples[start epoch seconds, end epoch seconds, plan], sorted and not overlapping
+    :param max_gap: int maximum accepted interval between samples in seconds
+    :return: tuple[array of energy in kWh for each window, float energy in kWh outside of windows]
+    """
+    if len(times) < 2:
+        return np.zeros(len(windows)), 0.0
+
+    dt = np.diff(times)
+    energy = (power[1:] + power[:-1]) / 2 * dt / 3600000  # Ws -> kWh
+    energy[dt > max_gap] = 0
+
+    if not windows:
+        return np.zeros(0), float(energy.sum())
+
+    mid = (times[1:] + times[:-1]) / 2
+    starts = np.array([w[0] for w in windows], dtype=float)
+    ends = np.array([w[1] for w in windows], dtype=float)
+
+    index = np.searchsorted(starts, mid, side='right') - 1
+    inside = (index >= 0) & (mid < ends[np.clip(index, 0, None)])
+    window_energy = np.bincount(index[inside], weights=energy[inside], minlength=len(windows))
+
+    return window_energy, float(energy[~inside].sum())
+
+
+# Control functions
+def reportDay(db, day):
+    """Compute and store energy accounting of one day.
+
+    :param db: InfluxDBClient object
+    :param day: string date YYYY-MM-DD
+    :return: dictionary{plan:kWh} with daily summary
+    """
+    day_start = dayToEpoch(day)
+    times, power = queryPowerForDay(db, day)
+    windows = heatingWindows(querySwitchingForDay(db, day), day_start, day_start + 86400)
+    window_energy, idle_energy = integrateEnergy(times, power, windows)
+
+    writeSummary(db, day, windows, window_energy, idle_energy)
+
+    summary = {'idle': round(idle_energy, 4)}
+    for (_, _, plan), kwh in zip(windows, window_energy):
+        summary[plan] = round(summary.get(plan, 0) + float(kwh), 4)
+
+    return summary
+
+
+def reportPeriod(db, first_day, last_day):
+    """Compute and store energy accounting day by day for given period, both days included.
+
+    :param db: InfluxDBClient object
+    :param first_day: string date YYYY-MM-DD
+    :param last_day: string date YYYY-MM-DD
+    """
+    day = datetime.strptime(first_day, '%Y-%m-%d')
+    end = datetime.strptime(last_day, '%Y-%m-%d')
+
+    while day <= end:
+        d = str(day.date())
+        print(d, reportDay(db, d))
+        day += timedelta(days=1)
+
+
+# ===================================== #
+#                 MAIN                  #
+# ===================================== #
+
+if __name__ == '__main__':
+    import influxdb
+
+    client = influxdb.InfluxDBClient(host='localhost', port=8086, username='telegraf', password='telegraf',
+                                     database='sensors')
+
+    yesterday = str((datetime.now(timezone.utc) - timedelta(days=1)).date())   # last ended UTC day
+    first = sys.argv[1] if len(sys.argv) > 1 else yesterday
+    last = sys.argv[2] if len(sys.argv) > 2 else (first if len(sys.argv) > 1 else yesterday)
+
+    reportPeriod(client, first, last)
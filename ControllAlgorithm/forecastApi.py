@@ -0,0 +1,186 @@
+"""
+Local HTTP and command line API returning prediction, planned socket switching windows and their inputs for given
+date and parameters(tank volume, limit tank temperature). Results are memoized with LRU eviction, keyed on version
+of input data and parameters, so repeated queries don't recompute the forecast from Influxdb data. Data version
+itself is reused for version_ttl, so repeated queries within it don't query Influxdb at all.
+
+Usage: python3 forecastApi.py [YYYY-MM-DD] [--tank-volume 80] [--limit-tank-temp 40]
+       python3 forecastApi.py --serve 8085
+       GET http://localhost:8085/forecast?date=YYYY-MM-DD&tank_volume=80&limit_tank_temp=40
+
+author: J.Mitura (xmitur01)
+version: 1.0
+"""
+import argparse
+import functools
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+import dbGuard
+import smartBoiler
+from waterPhysics import tank_volume, limit_tank_temp
+
+cache_size = 128  # number of memoized forecasts
+db_errors = (dbGuard.CircuitOpenError, InfluxDBClientError, InfluxDBServerError, OSError)  # OSError covers timeouts
+version_ttl = 60  # [s] data version is reused this long, history days are at least a week old and rarely change
+
+version_cache = {}  # key: (time of store, value)
+version_lock = threading.Lock()
+
+
+def memoizedVersion(key, compute):
+    """Return value stored under key if it is younger than version_ttl, otherwise compute and store it.
+
+    :param key: hashable cache key
+    :param compute: function without arguments computing the value
+    :return: cached or computed value
+    """
+    now = time.monotonic()
+    with version_lock:
+        stored = version_cache.get(key)
+        if stored is not None and now - stored[0] < version_ttl:
+            return stored[1]
+
+    value = compute()
+    with version_lock:
+        for k in [k for k, (t, _) in version_cache.items() if now - t >= version_ttl]:
+            del version_cache[k]
+        version_cache[key] = (now, value)
+
+    return value
+
+
+def dataVersion(day):
+    """Determine version of input data for forecast of given day. Version changes when first record changes or when
+    number of records in any of used past days changes. First record date and record counts of the day are memoized
+    for version_ttl, so repeated queries don't touch Influxdb.
+
+    :param day: string date YYYY-MM-DD
+    :return: tuple[string first record date, tuple of record counts]
+    """
+    first_date = memoizedVersion('first_date', lambda: smartBoiler.queryFirstTankValue()['time'].split('T')[0])
+
+    return first_date, memoizedVersion((day, first_date), lambda: recordCounts(day, first_date))
+
+
+def recordCounts(day, first_date):
+    """Count records of past days used for forecast of given day.
+
+    :param day: string date YYYY-MM-DD
+    :param first_date: string date YYYY-MM-DD of first record
+    :return: tuple of record counts, one tuple(pipe, tank) per past day
+    """
+    counts = []
+
+    for week in range(smartBoiler.historyWeeks(first_date, day), 0, -1):
+        past_day = smartBoiler.getDateNDaysAgo(7 * week, day)
+        date_val = {'start_time': past_day + 'T00:00:00Z', 'end_time': past_day + 'T23:59:59Z'}
+        res = smartBoiler.client.query('SELECT count("value") FROM temp_pipe, temp_tank '
+                                       'WHERE time >= $start_time AND time <= $end_time', bind_params=date_val)
+        counts.append(tuple(point['count'] for point in res.get_points()))
+
+    return tuple(counts)
+
+
+@functools.lru_cache(maxsize=cache_size)
+def cachedForecast(day, volume, limit_temp, version):
+    """Compute prediction and switching plan, result is memoized. Version argument is part of cache key only.
+
+    :param day: string date YYYY-MM-DD
+    :param volume: float tank volume in liters
+    :param limit_temp: float lowest allowed water temperature in deg of C
+    :param version: data version created by dataVersion
+    :return: string JSON document
+    """
+    usages = smartBoiler.usageHistory(day=day, volume=volume)
+    prediction = smartBoiler.predict(usages) if usages else []
+
+    if any(prediction):
+        plan = smartBoiler.planWindows(prediction, day, volume=volume, limit_temp=limit_temp)
+        plan_type = 'planned'
+        windows = [(plan['on'], plan['off'])]
+        afternoon = plan['afternoon']
+    else:
+        plan_type = 'base'
+        windows = smartBoiler.baseWindows(day)
+        afternoon = None
+
+    result = {'date': day,
+              'parameters': {'tank_volume': volume, 'limit_tank_temp': limit_temp},
+              'inputs': {'first_record_date': version[0], 'record_counts': version[1], 'usage_history': usages},
+              'prediction': prediction,
+              'plan': {'type': plan_type, 'windows': windows, 'afternoon_planning': afternoon}}
+
+    return json.dumps(result)
+
+
+def forecast(day=None, volume=tank_volume, limit_temp=limit_tank_temp):
+    """Return prediction, planned switching windows and inputs for given date and parameters.
+
+    :param day: string date YYYY-MM-DD, today when not set
+    :param volume: float tank volume in liters
+    :param limit_temp: float lowest allowed water temperature in deg of C
+    :return: string JSON document
+    """
+    if day is None:
+        day = str(datetime.date(datetime.now()))
+    datetime.strptime(day, '%Y-%m-%d')  # raises ValueError on wrong format
+
+    return cachedForecast(day, float(volume), float(limit_temp), dataVersion(day))
+
+
+class ForecastHandler(BaseHTTPRequestHandler):
+    """HTTP request handler, serves /forecast and /cache endpoints."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        try:
+            if url.path == '/forecast':
+                body = forecast(day=params.get('date'), volume=params.get('tank_volume', tank_volume),
+                                limit_temp=params.get('limit_tank_temp', limit_tank_temp))
+            elif url.path == '/cache':
+                body = json.dumps(cachedForecast.cache_info()._asdict())
+            else:
+                self.send_error(404)
+                return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except db_errors as e:
+            self.send_error(503, "Influxdb unavailable: %s" % e)
+            return
+
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# ===================================== #
+#                 MAIN                  #
+# ===================================== #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SmartBoiler forecast and plan query API")
+    parser.add_argument('date', nargs='?', help="predicted date YYYY-MM-DD, today by default")
+    parser.add_argument('--tank-volume', type=float, default=tank_volume, help="tank volume [l]")
+    parser.add_argument('--limit-tank-temp', type=float, default=limit_tank_temp, help="limit tank temperature [C]")
+    parser.add_argument('--serve', type=int, metavar='PORT', help="run HTTP server on given port")
+    args = parser.parse_args()
+
+    if args.serve:
+        server = ThreadingHTTPServer(('localhost', args.serve), ForecastHandler)
+        print("Serving forecast API on http://localhost:%d" % args.serve)
+        server.serve_forever()
+    else:
+        print(json.dumps(json.loads(forecast(args.date, args.tank_volume, args.limit_tank_temp)), indent=2))
@@ -0,0 +1,119 @@
+"""
+Cache of smart plug state used by SmartBoiler control algorithm to skip switching commands which would not change
+anything. State is updated from command acknowledgements, from power readings published on MQTT server
+by HS110/energyUsage.py and by regular resynchronization with the device.
+
+author: J.Mitura (xmitur01)
+version: 1.0
+"""
+import threading
+import time
+
+
+# ===================================== #
+#               CONSTANTS               #
+# ===================================== #
+
+power_measurement = 'power'  # record name published by HS110/energyUsage.py
+power_site = 'bathroom'  # site of the boiler plug
+power_on_threshold = 50  # [W] power above this value means heater relay is on
+max_state_age = 600  # [s] cached state older than this is not trusted
+power_grace = 15  # [s] power readings after command are ignored, they may be read before it(5 s poll + 3 s timeout)
+
+state = None  # True on, False off, None unknown
+state_time = 0
+confirmed_time = -power_grace  # time of last state confirmed by the plug itself
+commands_sent = 0
+commands_saved = 0
+lock = threading.Lock()
+
+
+def updateState(is_on):
+    """Store plug state confirmed by command acknowledgement or read from the plug.
+
+    :param is_on: bool actual plug state, None when state is unknown
+    """
+    global state, state_time, confirmed_time
+
+    with lock:
+        state = None if is_on is None else bool(is_on)
+        state_time = confirmed_time = time.monotonic()
+
+
+def updateFromPower(power):
+    """Store plug state based on power reading, power above threshold confirms plug is on. Power close to zero does
+    not mean plug is off, heater thermostat may be open while relay is on. Reading is ignored within power_grace after
+    confirmed state, it may have been taken before the command and would override newer acknowledgement.
+
+    :param power: float power in W or None
+    """
+    global state, state_time
+
+    with lock:
+        now = time.monotonic()
+        if power is None or power <= power_on_threshold or now - confirmed_time < power_grace:
+            return
+        state = True
+        state_time = now
+
+
+def needsSwitch(is_on):
+    """Decide if switching command has to be sent to plug. Command is skipped when fresh cached state already matches
+    the requested one.
+
+    :param is_on: bool requested plug state
+    :return: bool True when command has to be sent
+    """
+    global commands_sent, commands_saved
+
+    with lock:
+        fresh = (time.monotonic() - state_time) <= max_state_age
+        if state is not None and fresh and state == bool(is_on):
+            commands_saved += 1
+            return False
+
+        commands_sent += 1
+        return True
+
+
+def parsePowerPayload(payload):
+    """Read power value from line protocol message published by HS110/energyUsage.py, message can contain records
+    of several plugs on separate lines.
+
+    :param payload: bytes or string message eg. power,site=bathroom value=2400.0
+    :return: float power in W or None when message doesn't contain power record of boiler plug
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode()
+
+    for line in payload.split('\n'):
+        try:
+            tags, fields = line.split(' ', 1)
+            name, site = tags.split(',site=', 1)
+            value = float(fields.split('value=', 1)[1])
+        except (ValueError, IndexError):
+            continue
+
+        if name == power_measurement and site == power_site:
+            return value
+
+    return None
+
+
+def onMessage(client, userdata, message):
+    """MQTT client callback, updates cached state from power reading of boiler plug.
+
+    :param client: MQTT client object
+    :param userdata: user data set for MQTT client
+    :param message: MQTT message object
+    """
+    updateFromPower(parsePowerPayload(message.payload))
+
+
+def report():
+    """Return string with cache statistics for logging.
+
+    :return: string with numbers of sent and saved commands
+    """
+    with lock:
+        return "Plug state %s, commands sent: %d, commands saved: %d" % (state, commands_sent, commands_saved)
@@ -0,0 +1,183 @@
+"""
+Prediction accuracy evaluation of SmartBoiler. Stores predictions and actual water usage profiles(96 15 minutes
+intervals per day) in Influxdb and computes error metrics per day and per hour of day for stored predictions and for
+predictions made from 2, 3 and 4 weeks of history. All days of evaluated period are processed at once as matrices.
+
+author: J.Mitura (xmitur01)
+version: 1.0
+"""
+from datetime import datetime, timezone
+
+import numpy as np
+
+from energyReport import dayToEpoch
+
+slots_per_day = 96
+
+
+# Metrics
+def MAPE(actual, predicted, axis=None):
+    """Mean average percentage error. Intervals with zero actual usage are left out, percentage error is not defined
+    for them.
+
+    :param actual: real value series or matrix
+    :param predicted: predicted value series or matrix
+    :param axis: int axis along which error is computed, whole input when not set
+    :return: float or array, nan when there is no interval with usage
+    """
+    actual = np.asarray(actual, dtype=float)
+    predicted = np.asarray(predicted, dtype=float)
+
+    used = actual != 0
+    ape = np.abs(actual - predicted) / np.where(used, np.abs(actual), 1)
+    count = used.sum(axis=axis)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mape = np.where(count > 0, np.sum(np.where(used, ape, 0), axis=axis) / count * 100, np.nan)
+
+    return mape
+
+
+def WAPE(actual, predicted, axis=None):
+    """Weighted average percentage error, sum of absolute errors divided by sum of actual usage.
+
+    :param actual: real value series or matrix
+    :param predicted: predicted value series or matrix
+    :param axis: int axis along which error is computed, whole input when not set
+    :return: float or array, nan when there is no usage
+    """
+    actual = np.asarray(actual, dtype=float)
+    predicted = np.asarray(predicted, dtype=float)
+    total = np.sum(actual, axis=axis)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wape = np.where(total > 0, np.sum(np.abs(actual - predicted), axis=axis) / total * 100, np.nan)
+
+    return wape
+
+
+def errorMetrics(actual, predicted):
+    """Compute error metrics of daily usage profiles, per day and per hour of day.
+
+    :param actual: matrix days x 96 intervals of actual usage
+    :param predicted: matrix days x 96 intervals of predicted usage
+    :return: dictionary{daily: dictionary of arrays(days), hourly: dictionary of matrices(days x 24)}
+    """
+    hourly_actual = actual.reshape(len(actual), 24, -1).sum(axis=2)
+    hourly_predicted = predicted.reshape(len(predicted), 24, -1).sum(axis=2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hourly_ape = np.where(hourly_actual > 0,
+                              np.abs(hourly_actual - hourly_predicted) / hourly_actual * 100, np.nan)
+
+    return {'daily': {'mape': MAPE(actual, predicted, axis=1),
+                      'wape': WAPE(actual, predicted, axis=1),
+                      'mae': np.mean(np.abs(actual - predicted), axis=1),
+                      'actual_l': actual.sum(axis=1),
+                      'predicted_l': predicted.sum(axis=1)},
+            'hourly': {'abs_error': np.abs(hourly_actual - hourly_predicted),
+                       'ape': hourly_ape,
+                       'actual_l': hourly_actual}}
+
+
+def shiftDays(matrix, n):
+    """Shift matrix of daily profiles by n days, so row i contains profile of day i - n. Missing rows are nan.
+
+    :param matrix: matrix days x intervals
+    :param n: int number of days
+    :return: shifted matrix of the same shape
+    """
+    shifted = np.full(matrix.shape, np.nan)
+    if n < len(matrix):
+        shifted[n:] = matrix[:len(matrix) - n]
+
+    return shifted
+
+
+# DB queries and operations
+def queryMatrix(db, measurement, days):
+    """Query stored series of 15 minutes intervals for given days and arrange them to matrix.
+
+    :param db: InfluxDBClient object
+    :param measurement: string measurement name(usage_profile or prediction)
+    :param days: list of string dates YYYY-MM-DD, consecutive
+    :return: matrix days x 96 intervals, nan where value is missing
+    """
+    matrix = np.full((len(days), slots_per_day), np.nan)
+    start = dayToEpoch(days[0])
+
+    date_val = {'start_time': days[0] + 'T00:00:00Z', 'end_time': days[-1] + 'T23:59:59Z'}
+    res = db.query('SELECT "value" FROM %s WHERE time >= $start_time AND time <= $end_time' % measurement,
+                   bind_params=date_val, epoch='s')
+
+    times = []
+    values = []
+    for point in res.get_points():
+        times.append(point['time'])
+        values.append(point['value'])
+
+    if times:
+        index = (np.array(times, dtype=np.int64) - start) // (86400 // slots_per_day)
+        matrix.reshape(-1)[index] = values
+
+    return matrix
+
+
+def lastEvaluatedDay(db):
+    """Find day of the latest stored prediction error record.
+
+    :param db: InfluxDBClient object
+    :return: string date YYYY-MM-DD or None when nothing is evaluated yet
+    """
+    res = db.query('SELECT last("mae") FROM prediction_error', epoch='s')
+    point = next(res.get_points(), None)
+
+    if point is None:
+        return None
+
+    return str(datetime.fromtimestamp(int(point['time']), timezone.utc).date())
+
+
+def writeSeries(db, measurement, day, values):
+    """Store series of 15 minutes intervals of given day(prediction or actual usage profile).
+
+    :param db: InfluxDBClient object
+    :param measurement: string measurement name(usage_profile or prediction)
+    :param day: string date YYYY-MM-DD
+    :param values: list of numbers, length = 96
+    """
+    start = dayToEpoch(day)
+    step = 86400 // slots_per_day
+
+    db.write_points([{'measurement': measurement, 'time': start + i * step, 'fields': {'value': float(v)}}
+                     for i, v in enumerate(values)], time_precision='s')
+
+
+def writeErrors(db, days, source, metrics):
+    """Store error metrics of evaluated days, fields with undefined(nan) value are left out.
+
+    :param db: InfluxDBClient object
+    :param days: list of string dates YYYY-MM-DD
+    :param source: string prediction source(stored, weeks_2, weeks_3, weeks_4)
+    :param metrics: dictionary created by errorMetrics
+    """
+    points = []
+    daily = metrics['daily']
+    hourly = metrics['hourly']
+
+    for i, day in enumerate(days):
+        if np.isnan(daily['mae'][i]):
+            continue    # no prediction or no actual usage profile for the day
+        start = dayToEpoch(day)
+
+        fields = {name: round(float(v[i]), 3) for name, v in daily.items() if not np.isnan(v[i])}
+        points.append({'measurement': 'prediction_error', 'tags': {'source': source}, 'time': start,
+                       'fields': fields})
+
+        for h in range(24):
+            fields = {name: round(float(v[i, h]), 3) for name, v in hourly.items() if not np.isnan(v[i, h])}
+            points.append({'measurement': 'prediction_error_hourly', 'tags': {'source': source, 'hour': str(h)},
+                           'time': start + h * 3600, 'fields': fields})
+
+    if points:
+        db.write_points(points, time_precision='s', batch_size=5000)
@@ -8,26 +8,59 @@ import influxdb
 import kasa
 import asyncio
 import math
-from datetime import datetime, timedelta
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.background import BackgroundScheduler
 import time
+import paho.mqtt.client as mqtt
 
 import numpy as np
 
+import dbGuard
+import plugState
+import predictionAccuracy
+
+from energyReport import reportDay
+from waterPhysics import timeTillHeated, calculateUsedWater, normalizeUsedWater, minTankTemp, wrapTempToWater, \
+    wrapTempToWaterTemp, limit_tank_temp, tank_volume
+
 
 # Time/date calculations
-def getDateNDaysAgo(n_days):
+def getDateNDaysAgo(n_days, day=None):
     """Calculate date before N days ago.
 
     :param n_days: int number of days
+    :param day: string date YYYY-MM-DD to count from, today when not set
     :return: string date YYYY-MM-DD
     """
-    today = datetime.now()
+    today = datetime.now() if day is None else datetime.strptime(day, '%Y-%m-%d')
     n_days_date = today - timedelta(days=n_days)
 
     return str(n_days_date.date())
 
 
+def lastEndedDay():
+    """Determine last day which already ended in UTC, days of Influxdb queries are UTC days.
+
+    :return: string date YYYY-MM-DD
+    """
+    return str((datetime.now(timezone.utc) - timedelta(days=1)).date())
+
+
+def minutesToTime(day, minutes):
+    """Convert minutes from midnight to time used for scheduling, time is limited to given day.
+
+    :param day: string date YYYY-MM-DD
+    :param minutes: number of minutes from midnight
+    :return: string time YYYY-MM-DD hh:mm:00
+    """
+    minutes = min(max(int(minutes), 0), 24 * 60 - 1)
+
+    return day + " " + formatTime(str(minutes // 60)) + ":" + formatTime(str(minutes % 60)) + ":00"
+
+
 def formatTime(t):
     """Check if hour, minute, second variable has format hh, mm or ss if not change format.
 
@@ -80,6 +113,18 @@ def queryFirstTankValue():
     return next(res_tank.get_points())
 
 
+def writeSwitchRecord(state, plan):
+    """Store executed plug switching in Influxdb, used by energy accounting.
+
+    :param state: int 1 when plug was turned on, 0 when turned off
+    :param plan: string plan type which requested switching(base, planned, fallback, afternoon, limit)
+    """
+    try:
+        client.write_points([{'measurement': 'plug_switch', 'tags': {'plan': plan}, 'fields': {'value': state}}])
+    except Exception as e:
+        print("Failed to store plug switching: %r" % e)
+
+
 def pointsToList(points):
     """Convert query response from point in time, value format to list with values only.
 
@@ -93,108 +138,6 @@ def pointsToList(points):
     return list_of_points
 
 
-# Calculations
-def heatEnergy(desired_temp, actual_temp):
-    """Calculate heat energy based on temperature difference.
-
-    :param desired_temp: float number
-    :param actual_temp: float number
-    :return: float heat
-    """
-    q = tank_volume * thermal_capacity_H2O * (desired_temp - actual_temp)
-
-    return q
-
-
-def timeTillHeated(desired_temp, actual_temp):
-    """Calculate time needed to heat water on specific temperature. Using heater power and eta.
-
-    :param desired_temp: float number
-    :param actual_temp: float number
-    :return: float time in minutes
-    """
-    t = heatEnergy(desired_temp, actual_temp) / (heater_power * eta)
-
-    return t / 60
-
-
-def calculateUsedWater(temp_tank_before, temp_tank_after):
-    """Calculate amount of used water based on temperature change and tank volume.
-
-    :param temp_tank_before: float number
-    :param temp_tank_after: float number
-    :return: float used water volume in liters
-    """
-    used_w = (tank_volume * (temp_tank_after - temp_tank_before)) / (avr_cold_H2O_temp - temp_tank_before)
-
-    return used_w
-
-
-def normalizeUsedWater(temp_tank_before, temp_tank_after, used_volume):
-    """Calculate amount of used water with normalized temperature 37deg of C
-
-    :param temp_tank_before: float number
-    :param temp_tank_after: float number
-    :param used_volume: float volume in liters
-    :return: float used water in liters
-    """
-    # mean = (temp_tank_before + temp_tank_after)/2
-
-    normalized_usage = used_volume + (
-                (used_volume * (temp_tank_before - normal_H2O_temp)) / (normal_H2O_temp - avr_cold_H2O_temp))
-
-    return normalized_usage
-
-
-def calculateMaxProductionCapability(actual_tank_temp):
-    """Calculate maximum available water volume when using water of temperature 37deg of C
-
-    :param actual_tank_temp: float number
-    :return: float available water in liters
-    """
-    max_prod = tank_volume + (
-            tank_volume * (actual_tank_temp - normal_H2O_temp) / (normal_H2O_temp - avr_cold_H2O_temp))
-
-    return max_prod
-
-
-def minTankTemp(water_usage):
-    """Calculate minimum tank temperature which satisfies predicted usage of water of temperature 37deg of C
-
-    :param water_usage: float number
-    :return: float number temp in deg of C
-    """
-    min_temp = ((limit_tank_temp * tank_volume) - (avr_cold_H2O_temp * water_usage)) / (tank_volume - water_usage)
-
-    return min_temp
-
-
-# calculations based on experiment, used due to lack of analog thermometer shaft on tank, accurate in range 40 to 70 deg
-def wrapTempToWaterTemp(temp_before, temp_after):
-    """Calculates actual temperature of water in tank based on wrap temperature.
-
-    :param temp_before: float number
-    :param temp_after: float number
-    :return: float number temp in deg of C
-    """
-    diff = 13.5  # difference between tank wrap and water temperature at when sensor at 42 deg
-    diff_change = 0.525  # diff change per 0.1 change on sensor
-    water_change = 0.625  # water temperature change per 0.1 change on sensor
-
-    if temp_before >= 42:
-        real_before = temp_before + ((temp_before - 42) * 10 * diff_change + diff)
-    elif temp_before < 42:
-        real_before = temp_before + (diff - ((42 - temp_before) * 10 * diff_change))
-    # real_before = temp_before + diff
-
-    if temp_before < 38:
-        real_before = temp_before  # air temperature plays more significant role
-
-    real_after = real_before + (temp_after - temp_before) * 10 * water_change
-
-    return real_before, real_after
-
-
 # Data filters
 def detectFallingSeq(points_list):
     """Find falling temperatures sequences in given list and stores beginnings and ends of them in list.
@@ -223,109 +166,53 @@ def detectFallingSeq(points_list):
 
 
 def afternoonMinimum(data_list):
-    """Find index of hour where afternoon water usage minimum is located, searching between 13pm and 15pm.
+    """Find index of interval where afternoon water usage minimum is located, searching between 12pm and 15pm.
 
-    :param data_list: list of floats, length = 24
+    :param data_list: list of floats, length = 96
     :return: int number index
     """
-    index = 12
-    tmp = data_list[12]
-    for i in range(13, 15):
-        if tmp > data_list[i]:
-            tmp = data_list[i]
-            index = i
+    first = 12 * 60 // slot_minutes
+    last = 15 * 60 // slot_minutes
 
-    return index
+    return first + int(np.argmin(data_list[first:last]))
 
 
 # Data process
-def dailyUsagePer15minn(index_list, tank_data_list):
+def dailyUsagePer15minn(index_list, tank_data_list, volume=tank_volume):
     """Process tank temperatures series to water usage series divided into 96 15 minutes intervals, where each
-    interval has value in liters equal to used normalized hot water(37deg of c).
+    interval has value in liters equal to used normalized hot water(37deg of c). Usage is assigned to interval
+    where falling sequence starts.
 
     :param index_list: list of indexes
     :param tank_data_list: list of tank temperatures
+    :param volume: float tank volume in liters
     :return: list of numbers, length = 96
     """
-    first_use = tank_data_list[index_list[1]]
-    hh_mm = first_use['time'].split('T')[1]
-    zero_intervals = int(hh_mm[0:2]) * 4  # from midnight till first use hours
-    zero_intervals += int(hh_mm[3:5]) // 15  # floor division for minutes
-
-    usage = [0] * zero_intervals  # fill intervals till first use of day
+    starts = index_list[0:len(index_list) - 1:2]
+    ends = index_list[1:len(index_list):2]
 
-    for i in range(0, len(index_list) - 1, 2):
-        tank_before = float(tank_data_list[index_list[i]]['value'])
-        tank_after = float(tank_data_list[index_list[i + 1]]['value'])
+    tank_before = np.array([float(tank_data_list[i]['value']) for i in starts])
+    tank_after = np.array([float(tank_data_list[i]['value']) for i in ends])
 
-        water_before, water_after = wrapTempToWaterTemp(temp_before=tank_before, temp_after=tank_after)
+    water_before, water_after = wrapTempToWaterTemp(temp_before=tank_before, temp_after=tank_after)
+    used = calculateUsedWater(temp_tank_before=water_before, temp_tank_after=water_after, volume=volume)
+    normalized = np.round(np.abs(normalizeUsedWater(temp_tank_before=water_before, temp_tank_after=water_after,
+                                                    used_volume=used)), 2)
 
-        used = calculateUsedWater(temp_tank_before=water_before, temp_tank_after=water_after)
+    slots = []
+    for i in starts:
+        hh_mm = tank_data_list[i]['time'].split('T')[1]
+        slots.append((int(hh_mm[0:2]) * 60 + int(hh_mm[3:5])) // slot_minutes)
 
-        # add new interval with usage or extend last, depending on time
-        if i > 0:
-            t = tank_data_list[index_list[i]]['time'].split('T')[1]
-            past = tank_data_list[index_list[i - 2]]['time'].split('T')[1]
+    usage = np.bincount(np.array(slots, dtype=int), weights=normalized, minlength=24 * 60 // slot_minutes)
 
-            if (int(t[0:2]) - int(past[0:2])) == 0 and ((int(t[3:5]) // 15) == (int(past[3:5]) // 15)):
-                usage[-1] = float(usage[-1]) + round(abs(normalizeUsedWater(
-                    temp_tank_before=water_before, temp_tank_after=water_after, used_volume=used)), 2)
-            else:
-                usage.append(round(abs(normalizeUsedWater(temp_tank_before=water_before,
-                                                          temp_tank_after=water_after, used_volume=used)), 2))
-        else:
-            usage.append(round(abs(normalizeUsedWater(temp_tank_before=water_before,
-                                                      temp_tank_after=water_after, used_volume=used)), 2))
-
-        # fill gaps between intervals with usage by intervals with 0
-        if i + 2 <= len(index_list) - 1:
-            last_time = tank_data_list[index_list[i]]['time'].split('T')[1]
-            next_time = tank_data_list[index_list[i + 2]]['time'].split('T')[1]
-            hour_difference = (int(next_time[0:2]) - int(last_time[0:2]))
-
-            if hour_difference == 0:
-                gap = ((int(next_time[3:5]) // 15) - (int(last_time[3:5]) // 15)) - 1
-                if gap > 0:
-                    usage.extend([0] * gap)
-            elif hour_difference == 1:
-                gap = (4 - ((int(last_time[3:5]) // 15) + 1)) + (int(next_time[3:5]) // 15)
-                if gap > 0:
-                    usage.extend([0] * gap)
-            else:
-                gap = (4 - ((int(last_time[3:5]) // 15) + 1)) + (int(next_time[3:5]) // 15)
-                gap += (hour_difference - 1) * 4
-                if gap > 0:
-                    usage.extend([0] * gap)
-
-    # fill intervals from last use of day till midnight
-    last_use = tank_data_list[index_list[-2]]
-    hh_mm = last_use['time'].split('T')[1]
-    gap = ((24 - int(hh_mm[0:2])) - 1) * 4
-    gap += 4 - ((int(hh_mm[3:5]) // 15) + 1)
-    if gap > 0:
-        usage.extend([0] * gap)
-
-    return usage
-
-
-def usage15minTo1hTransform(usage_list):
-    """Transforms series of water usage in 15 minutes intervals into 1 hour intervals.
-
-    :param usage_list: list of numbers
-    :return: list of numbers(usage hourly)
-    """
-    usage = []
-    for i in range(0, len(usage_list) - 1, 4):
-        h = float(usage_list[i]) + float(usage_list[i + 1]) + float(usage_list[i + 2]) + float(usage_list[i + 3])
-        usage.append(round(h, 2))
-
-    return usage
+    return [round(u, 2) for u in usage.tolist()]
 
 
 def ema(values, n):
     """Calculates actual value of exponential moving average of given series with certain length.
 
-    :param values: list of floats
+    :param values: list of floats or list of numpy arrays(EMA computed element wise)
     :param n: int ema length
     :return: float actual ema value
     """
@@ -347,70 +234,99 @@ def ema(values, n):
 
 def predict(list_of_usage_lists):   # list of lists [oldest data, -> ,newest data]
     """Predict today usage based on historical usage of 2,3 or 4 previous same days of week.
+    EMA is computed for all intervals at once.
 
     :param list_of_usage_lists: list of time series usage lists
-    :return: list of floats(hourly usage prediction)
+    :return: list of floats(usage prediction in 15 minutes intervals)
     """
-    p = []
     n = len(list_of_usage_lists)
 
-    if n == 2:
-        u1 = list_of_usage_lists[1]
-        u2 = list_of_usage_lists[0]
-        for i in range(0, 24):
-            p.append(round(ema([u2[i], u1[i]], n), 2))
-    elif n == 3:
-        u1 = list_of_usage_lists[2]
-        u2 = list_of_usage_lists[1]
-        u3 = list_of_usage_lists[0]
-        for i in range(0, 24):
-            p.append(round(ema([u3[i], u2[i], u1[i]], n), 2))
-    elif n == 4:
-        u1 = list_of_usage_lists[3]
-        u2 = list_of_usage_lists[2]
-        u3 = list_of_usage_lists[1]
-        u4 = list_of_usage_lists[0]
-        for i in range(0, 24):
-            p.append(round(ema([u4[i], u3[i], u2[i], u1[i]], n), 2))
+    if n not in (2, 3, 4):
+        return []
+
+    p = ema([np.array(u, dtype=float) for u in list_of_usage_lists], n)
+
+    return [round(v, 2) for v in p.tolist()]
 
-    return p
 
+# Socket switching
+def switchPlug(is_on):
+    """Send switching command to plug, using asyncio.run call. Command is skipped when cached plug state already
+    matches. If command fails cached state is dropped, so next request is sent to the plug.
+
+    :param is_on: bool requested plug state
+    """
+    if not plugState.needsSwitch(is_on):
+        return
+
+    try:
+        asyncio.run(plug.turn_on() if is_on else plug.turn_off())
+    except Exception:
+        plugState.updateState(None)
+        raise
+
+    plugState.updateState(is_on)
 
-# MAPE function for prediction accuracy determination
-def MAPE(actual, predicted):
-    """Mean average percentage error, used in prediction plotting.
 
-    :param actual: real value series
-    :param predicted: predicted value series
-    :return:
+def turnOff(plan="planned"):
+    """Switch plug to off state.
+
+    :param plan: string plan type which requested switching
     """
-    mape = np.mean(np.abs((actual - predicted) / actual)) * 100
-    return mape
+    switchPlug(False)
+    writeSwitchRecord(state=0, plan=plan)
 
 
-# Socket switching
-def turnOff():
-    """Switch plug to off state, using asyncio.run call."""
-    asyncio.run(plug.turn_off())
+def turnOn(plan="planned"):
+    """Switch plug to on state.
+
+    :param plan: string plan type which requested switching
+    """
+    switchPlug(True)
+    writeSwitchRecord(state=1, plan=plan)
+
 
+def syncPlugState():
+    """Read actual state from plug, store it in plug state cache and print cache statistics.
+    Run regularly in 10 minute intervals."""
+    try:
+        asyncio.run(plug.update())
+        plugState.updateState(plug.is_on)
+    except Exception:
+        plugState.updateState(None)
+        print("Failed to read plug state.")
 
-def turnOn():
-    """Switch plug to on state, using asyncio.run call."""
-    asyncio.run(plug.turn_on())
+    print(plugState.report())
+
+
+def onMqttConnect(client, userdata, flags, rc):
+    """MQTT client callback, subscribes to plug power readings after every (re)connection, broker doesn't keep
+    subscriptions of clean session.
+
+    :param client: MQTT client object
+    :param userdata: user data set for MQTT client
+    :param flags: dictionary of response flags sent by broker
+    :param rc: int connection result, 0 when successful
+    """
+    if rc == 0:
+        client.subscribe(mqttTopic)
+        print("Connected to %s MQTT broker" % mqttServerIP)
+    else:
+        print("Failed to connect to MQTT broker, result code %s." % rc)
 
 
 # Control functions
-def produceUsage(falling_sequence_indexes, tank_data_list):
-    """Creates hot water usage hourly series.
+def produceUsage(falling_sequence_indexes, tank_data_list, volume=tank_volume):
+    """Creates hot water usage series in 15 minutes intervals.
 
     :param falling_sequence_indexes: list of indexes(falling seq starts, ends)
     :param tank_data_list: list tank temperature series
-    :return: list of hourly predicted water usage 24h or empty list if error occurs
+    :param volume: float tank volume in liters
+    :return: list of water usage in 96 intervals or empty list if error occurs
     """
     u = []
-    if falling_sequence_indexes:
-        u = dailyUsagePer15minn(index_list=falling_sequence_indexes, tank_data_list=tank_data_list)
-        u = usage15minTo1hTransform(usage_list=u)
+    if len(falling_sequence_indexes) > 1:
+        u = dailyUsagePer15minn(index_list=falling_sequence_indexes, tank_data_list=tank_data_list, volume=volume)
 
     return u
 
@@ -423,24 +339,34 @@ def checkLimitTemp(sched):
 
     :param sched: APScheduler object, containing scheduler used in the script
     """
-    diff = 13.5  # difference between tank wrap and water temperature at when sensor at 42 deg
-    diff_change = 0.525  # diff change per 0.1 change on sensor
+    try:
+        actual_temp = queryLatestTankValue()['last']
+    except Exception as e:
+        print("Failed to read tank temperature: %r" % e)
+        return
 
-    actual_temp = queryLatestTankValue()['last']
-
-    if actual_temp >= 42:
-        real = actual_temp + ((actual_temp - 42) * 10 * diff_change + diff)
-    elif actual_temp < 42:
-        real = actual_temp + (diff - ((42 - actual_temp) * 10 * diff_change))
+    real = wrapTempToWater(actual_temp)
 
     if real <= 40:
-        turnOn()
+        turnOn(plan="limit")
 
         now = datetime.now()
         now_plus_10 = now + timedelta(minutes=4)
         t_off = str(now_plus_10).split('.')[0]
 
-        sched.add_job(func=turnOff, trigger='date', next_run_time=t_off)
+        # replace pending turn off of previous check, so jobs don't pile up while temperature stays low
+        sched.add_job(func=turnOff, args=["limit"], trigger='date', next_run_time=t_off, id='limit_turn_off',
+                      replace_existing=True)
+
+
+def baseWindows(day):
+    """Basic socket switching plan(static hours 1am to 6am, 13pm to 14pm).
+
+    :param day: string date YYYY-MM-DD
+    :return: list of tuples[string turn on time, string turn off time]
+    """
+    return [(day + " " + "01:00:00", day + " " + "06:00:00"),
+            (day + " " + "13:00:00", day + " " + "14:00:00")]
 
 
 def baseSwitching(sched):
@@ -451,143 +377,307 @@ def baseSwitching(sched):
     """
     d = datetime.date(datetime.now())
 
-    t_on = str(d) + " " + "01:00:00"
-    t_off = str(d) + " " + "06:00:00"
-    t_on2 = str(d) + " " + "13:00:00"
-    t_off2 = str(d) + " " + "14:00:00"
+    for t_on, t_off in baseWindows(str(d)):
+        sched.add_job(func=turnOn, args=["base"], trigger='date', next_run_time=t_on)
+        sched.add_job(func=turnOff, args=["base"], trigger='date', next_run_time=t_off)
 
-    sched.add_job(func=turnOn, trigger='date', next_run_time=t_on)
-    sched.add_job(func=turnOff, trigger='date', next_run_time=t_off)
-    sched.add_job(func=turnOn, trigger='date', next_run_time=t_on2)
-    sched.add_job(func=turnOff, trigger='date', next_run_time=t_off2)
 
+def planWindows(prediction, day, volume=tank_volume, limit_temp=limit_tank_temp):
+    """Plan socket turn on and off time based on water usage prediction and time needed for reaching desired
+    temperature, together with time of afternoon planning. Plug is turned off at start of interval with first
+    predicted usage.
 
-def planSwitchSocket(prediction, sched):
-    """Schedule socket turn on and off based on water usage prediction and time needed for reaching desired temperature.
-    Used in first planning before afternoon.
-
-    :param prediction: list of numbers with water usage prediction
-    :param sched: APScheduler object, containing scheduler used in the script
+    :param prediction: list of numbers with water usage prediction in 15 minutes intervals
+    :param day: string date YYYY-MM-DD
+    :param volume: float tank volume in liters
+    :param limit_temp: float lowest allowed water temperature in deg of C
+    :return: dictionary{on:string time, off:string time, afternoon:string time, afternoon_min:int interval index}
     """
     afternoon_min = afternoonMinimum(prediction)
-    usage_sum = sum(prediction[0:(afternoon_min - 1)])
-    t = math.ceil(timeTillHeated(minTankTemp(usage_sum), limit_tank_temp))
+    usage_sum = sum(prediction[0:afternoon_min])
+    t = math.ceil(timeTillHeated(minTankTemp(usage_sum, volume=volume, limit_temp=limit_temp), limit_temp,
+                                 volume=volume))
     first_use = next((index for index, value in enumerate(prediction) if value != 0), None)
+    first_use_minutes = first_use * slot_minutes
 
-    h = str((first_use * 60 - (t + 5)) // 60)
-    m = str((first_use * 60 - (t + 5)) % 60)
+    return {'on': minutesToTime(day, first_use_minutes - (t + 5)),
+            'off': minutesToTime(day, first_use_minutes),
+            'afternoon': minutesToTime(day, afternoon_min * slot_minutes),
+            'afternoon_min': afternoon_min}
 
-    h = formatTime(h)
-    m = formatTime(m)
-    d = datetime.date(datetime.now())
 
-    t_on = str(d) + " " + h + ":" + m + ":00"
-    t_off = str(d) + " " + formatTime(str(first_use)) + ":00:00"
-    t_afternoon = str(d) + " " + formatTime(str(afternoon_min)) + ":00:00"
+def planSwitchSocket(prediction, sched, plan_type="planned"):
+    """Schedule socket turn on and off based on water usage prediction and time needed for reaching desired temperature.
+    Used in first planning before afternoon.
 
-    sched.add_job(func=turnOn, trigger='date', next_run_time=t_on)
-    sched.add_job(func=turnOff, trigger='date', next_run_time=t_off)
-    sched.add_job(func=switchSocketAfternoon, args=[prediction, sched, afternoon_min], trigger='date',
-                  next_run_time=t_afternoon)
+    :param prediction: list of numbers with water usage prediction
+    :param sched: APScheduler object, containing scheduler used in the script
+    :param plan_type: string plan type recorded with switching, planned or fallback
+    """
+    plan = planWindows(prediction, str(datetime.date(datetime.now())))
+    now = str(datetime.now())
+
+    if plan['off'] <= now:   # first use is in already passed interval, nothing left to heat for
+        pass
+    elif plan['on'] <= now:   # heating takes longer than time till first use, start right away
+        turnOn(plan=plan_type)
+        sched.add_job(func=turnOff, args=[plan_type], trigger='date', next_run_time=plan['off'])
+    else:
+        sched.add_job(func=turnOn, args=[plan_type], trigger='date', next_run_time=plan['on'])
+        sched.add_job(func=turnOff, args=[plan_type], trigger='date', next_run_time=plan['off'])
+    sched.add_job(func=switchSocketAfternoon, args=[prediction, sched, plan['afternoon_min']], trigger='date',
+                  next_run_time=plan['afternoon'])
 
 
 def switchSocketAfternoon(prediction, sched, afternoon_min_index):
     """Schedule socket turn on and off based on water usage prediction and time needed for reaching desired temperature
     and actual tank temperature. Used in afternoon planning.
 
-    :param prediction: list of numbers with water usage prediction
+    :param prediction: list of numbers with water usage prediction in 15 minutes intervals
     :param sched: APScheduler object, containing scheduler used in the script
-    :param afternoon_min_index: index of afternoon hour with minimum water usage between 13pm and 15pm
+    :param afternoon_min_index: index of afternoon interval with minimum water usage between 12pm and 15pm
     """
-    usage_sum = sum(prediction[afternoon_min_index:23])
-    actual_temp = queryLatestTankValue()['last']
+    usage_sum = sum(prediction[afternoon_min_index:])
+    try:
+        actual_temp = queryLatestTankValue()['last']
+    except Exception as e:   # heat as if tank was on limit temperature
+        print("Failed to read tank temperature: %r" % e)
+        actual_temp = limit_tank_temp
     t = math.ceil(timeTillHeated(minTankTemp(usage_sum), actual_temp))
     if t > 0:
-        turnOn()
+        turnOn(plan="afternoon")
 
-        h = str((afternoon_min_index * 60 + t + 5) // 60)
-        m = str((afternoon_min_index * 60 + t + 5) % 60)
+        d = str(datetime.date(datetime.now()))
+        t_off = minutesToTime(d, afternoon_min_index * slot_minutes + t + 5)
+        sched.add_job(func=turnOff, args=["afternoon"], trigger='date', next_run_time=t_off)
 
-        h = formatTime(h)
-        m = formatTime(m)
-        d = datetime.date(datetime.now())
 
-        t_off = str(d) + " " + h + ":" + m + ":00"
-        sched.add_job(func=turnOff, trigger='date', next_run_time=t_off)
+def reportEnergy():
+    """Store energy accounting of last day which ended in UTC, energy report works with UTC days. Run regularly after
+    every midnight."""
+    day = lastEndedDay()
+    try:
+        reportDay(db=client, day=day)
+    except Exception as e:
+        print("Failed to store energy accounting of %s: %r" % (day, e))
 
 
-def makeForecast(sched):
-    """Main logical function of the script. Run regularly after every midnight. Determines the state of algorithm based
-    on days pass since day with first record and decides if prediction and plug switching is made on 2,3, or 4 same
-    past days of week or can't be done so base switching has to be applied.
+def historyWeeks(first_date, day):
+    """Determine how many same past days of week can be used for prediction, based on days passed since day with first
+    record.
 
-    :param sched:
-    :return:
+    :param first_date: string date YYYY-MM-DD of first record
+    :param day: string date YYYY-MM-DD of predicted day
+    :return: int number of weeks 2, 3, 4 or 0 when base switching has to be applied
     """
-    first_record_time = queryFirstTankValue()['time']
-    first_date = first_record_time.split('T')[0]
-    today_date = datetime.date(datetime.now())
-    d1 = datetime.date(datetime(int(first_date.split('-')[0]), int(first_date.split('-')[1]),
-                                int(first_date.split('-')[2])))
-
-    d_dif = (today_date - d1).days
-    prd = []
+    d_dif = (datetime.strptime(day, '%Y-%m-%d') - datetime.strptime(first_date, '%Y-%m-%d')).days
 
     if d_dif <= 14:
-        baseSwitching(sched=sched)
+        return 0
     elif 14 < d_dif <= 21:
-        list_p1, list_t1 = queryDataForDay(day=getDateNDaysAgo(7))
-        list_p2, list_t2 = queryDataForDay(day=getDateNDaysAgo(14))
+        return 2
+    elif 21 < d_dif <= 28:
+        return 3
 
-        falling_seq_indexes_1 = detectFallingSeq(points_list=list_p1)
-        falling_seq_indexes_2 = detectFallingSeq(points_list=list_p2)
+    return 4
 
-        use1 = produceUsage(falling_seq_indexes_1, list_t1)
-        use2 = produceUsage(falling_seq_indexes_2, list_t2)
-        if use1 and use2 and len(use1) == 24 and len(use2) == 24:
-            prd = predict([use2, use1])
-            planSwitchSocket(prediction=prd, sched=sched)
-        else:   # run base like when dif days < 14
-            baseSwitching(sched=sched)
 
-    elif 21 < d_dif <= 28:
-        list_p1, list_t1 = queryDataForDay(day=getDateNDaysAgo(7))
-        list_p2, list_t2 = queryDataForDay(day=getDateNDaysAgo(14))
-        list_p3, list_t3 = queryDataForDay(day=getDateNDaysAgo(21))
-
-        falling_seq_indexes_1 = detectFallingSeq(points_list=list_p1)
-        falling_seq_indexes_2 = detectFallingSeq(points_list=list_p2)
-        falling_seq_indexes_3 = detectFallingSeq(points_list=list_p3)
-
-        use1 = produceUsage(falling_seq_indexes_1, list_t1)
-        use2 = produceUsage(falling_seq_indexes_2, list_t2)
-        use3 = produceUsage(falling_seq_indexes_3, list_t3)
-        if use1 and use2 and use3 and len(use1) == 24 and len(use2) == 24 and use3 == 24:
-            prd = predict([use3, use2, use1])
-            planSwitchSocket(prediction=prd, sched=sched)
-        else:   # run base like when dif days < 14
-            baseSwitching(sched=sched)
-
-    elif d_dif > 28:
-        list_p1, list_t1 = queryDataForDay(day=getDateNDaysAgo(7))
-        list_p2, list_t2 = queryDataForDay(day=getDateNDaysAgo(14))
-        list_p3, list_t3 = queryDataForDay(day=getDateNDaysAgo(21))
-        list_p4, list_t4 = queryDataForDay(day=getDateNDaysAgo(28))
-
-        falling_seq_indexes_1 = detectFallingSeq(points_list=list_p1)
-        falling_seq_indexes_2 = detectFallingSeq(points_list=list_p2)
-        falling_seq_indexes_3 = detectFallingSeq(points_list=list_p3)
-        falling_seq_indexes_4 = detectFallingSeq(points_list=list_p4)
-
-        use1 = produceUsage(falling_seq_indexes_1, list_t1)
-        use2 = produceUsage(falling_seq_indexes_2, list_t2)
-        use3 = produceUsage(falling_seq_indexes_3, list_t3)
-        use4 = produceUsage(falling_seq_indexes_4, list_t4)
-        if use1 and use2 and use3 and use4 and len(use1) == 24 and len(use2) == 24 and use3 == 24 and use4 == 24:
-            prd = predict([use4, use3, use2, use1])
-            planSwitchSocket(prediction=prd, sched=sched)
-        else:   # run base like when dif days < 14
-            baseSwitching(sched=sched)
+def usageProfile(day, volume=tank_volume):
+    """Query and process water usage of given day.
+
+    :param day: string date YYYY-MM-DD
+    :param volume: float tank volume in liters
+    :return: list of water usage in 96 intervals or empty list when usage can't be determined
+    """
+    list_p, list_t = queryDataForDay(day=day)
+    use = produceUsage(detectFallingSeq(points_list=list_p), list_t, volume=volume)
+
+    return use if len(use) == 24 * 60 // slot_minutes else []
+
+
+def usageHistory(day, volume=tank_volume):
+    """Query and process water usage of same past days of week used for prediction of given day.
+
+    :param day: string date YYYY-MM-DD of predicted day
+    :param volume: float tank volume in liters
+    :return: list of usage lists [oldest data, -> ,newest data] or empty list when prediction can't be made
+    """
+    first_date = queryFirstTankValue()['time'].split('T')[0]
+    usages = []
+
+    for week in range(historyWeeks(first_date, day), 0, -1):
+        use = usageProfile(day=getDateNDaysAgo(7 * week, day), volume=volume)
+        if not use:
+            return []
+        usages.append(use)
+
+    return usages
+
+
+def evaluatePredictions():
+    """Compare predictions with actual water usage and store error metrics. Run regularly after every midnight, days
+    since last evaluated one till last ended UTC day are evaluated, so nights when evaluation failed are backfilled.
+    On first run all past days are evaluated.
+    """
+    try:
+        last_day = lastEndedDay()
+        last_evaluated = predictionAccuracy.lastEvaluatedDay(client)
+        if last_evaluated is not None:
+            first_day = getDateNDaysAgo(-1, last_evaluated)   # day after last evaluated one
+        else:
+            first_day = queryFirstTankValue()['time'].split('T')[0]
+
+        if first_day <= last_day:
+            evaluatePeriod(first_day, last_day)
+    except Exception as e:
+        print("Failed to evaluate predictions: %r" % e)
+
+
+def evaluatePeriod(first_day, last_day):
+    """Compare predictions with actual water usage of given period and store error metrics. Besides stored predictions,
+    predictions made from 2, 3 and 4 weeks of history are evaluated, for all days at once.
+
+    :param first_day: string date YYYY-MM-DD
+    :param last_day: string date YYYY-MM-DD
+    """
+    history_start = datetime.strptime(getDateNDaysAgo(28, first_day), '%Y-%m-%d')
+    days = [str((history_start + timedelta(days=i)).date())
+            for i in range((datetime.strptime(last_day, '%Y-%m-%d') - history_start).days + 1)]
+
+    # usage profiles are stored, so raw temperatures of each day are processed only once
+    profiles = predictionAccuracy.queryMatrix(client, 'usage_profile', days)
+    for i, day in enumerate(days):
+        if np.isnan(profiles[i]).all():
+            use = usageProfile(day=day)
+            if use:
+                profiles[i] = use
+                predictionAccuracy.writeSeries(client, 'usage_profile', day, use)
+
+    evaluated = slice(28, len(days))
+    predictions = {'stored': predictionAccuracy.queryMatrix(client, 'prediction', days)}
+    for weeks in (2, 3, 4):
+        history = [predictionAccuracy.shiftDays(profiles, 7 * week) for week in range(weeks, 0, -1)]
+        predictions['weeks_%d' % weeks] = np.round(ema(history, weeks), 2)
+
+    for source, predicted in predictions.items():
+        metrics = predictionAccuracy.errorMetrics(profiles[evaluated], predicted[evaluated])
+        predictionAccuracy.writeErrors(client, days[evaluated], source, metrics)
+
+
+def loadForecastCache():
+    """Load locally stored last good predictions and rolling average usage profile.
+
+    :return: dictionary{predictions:dictionary{string date: list prediction}, average:list or None}
+    """
+    try:
+        with open(forecast_cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'predictions': {}, 'average': None}
+
+
+def storeGoodPrediction(day, prediction):
+    """Store prediction locally to be used when Influxdb is not available. Predictions of last 7 days are kept
+    and rolling average profile is updated.
+
+    :param day: string date YYYY-MM-DD
+    :param prediction: list of numbers with water usage prediction
+    """
+    cache = loadForecastCache()
+    predictions = cache['predictions']
+    predictions[day] = prediction
+    for d in sorted(predictions)[:-7]:
+        del predictions[d]
+
+    average = cache['average']
+    if average is None or len(average) != len(prediction):
+        cache['average'] = prediction
+    else:
+        cache['average'] = np.round(0.8 * np.array(average) + 0.2 * np.array(prediction), 2).tolist()
+
+    tmp = forecast_cache_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, forecast_cache_file)
+
+
+def fallbackPrediction(day):
+    """Choose prediction used when forecast can't be made from Influxdb data. Last good prediction of same day of week
+    is preferred, then the latest one, then rolling average profile.
+
+    :param day: string date YYYY-MM-DD
+    :return: list of numbers with water usage prediction or empty list when base switching has to be applied
+    """
+    cache = loadForecastCache()
+    slots = 24 * 60 // slot_minutes
+    week_ago = getDateNDaysAgo(7, day)
+    recent = sorted(d for d, p in cache['predictions'].items() if week_ago <= d < day and len(p) == slots)
+
+    if week_ago in recent:
+        return cache['predictions'][week_ago]
+    if recent:
+        return cache['predictions'][recent[-1]]
+    if cache['average'] is not None and len(cache['average']) == slots:
+        return cache['average']
+
+    return []
+
+
+def forecastPrediction(day):
+    """Make prediction of water usage for given day from Influxdb data.
+
+    :param day: string date YYYY-MM-DD
+    :return: list of numbers with water usage prediction or empty list when there is not enough history
+    """
+    usages = usageHistory(day=day)
+
+    return predict(usages) if usages else []
+
+
+def forecastWithinBudget(day):
+    """Make prediction in worker thread and wait for it at most planning_budget seconds.
+
+    :param day: string date YYYY-MM-DD
+    :return: list of numbers with water usage prediction
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(forecastPrediction, day)
+    executor.shutdown(wait=False)
+
+    return future.result(timeout=planning_budget)
+
+
+def makeForecast(sched):
+    """Main logical function of the script. Run regularly after every midnight. Determines the state of algorithm based
+    on days pass since day with first record and decides if prediction and plug switching is made on 2,3, or 4 same
+    past days of week or can't be done so base switching has to be applied. When Influxdb is down or slow, locally
+    stored fallback prediction is used.
+
+    :param sched: APScheduler object, containing scheduler used in the script
+    """
+    today = str(datetime.date(datetime.now()))
+    plan_type = "planned"
+    try:
+        prd = forecastWithinBudget(today)
+    except Exception as e:
+        print("Forecast failed: %r, using fallback prediction." % e)
+        prd = fallbackPrediction(today)
+        plan_type = "fallback"
+
+    if any(prd) and plan_type == "planned":
+        try:
+            storeGoodPrediction(today, prd)
+        except OSError as e:
+            print("Failed to store prediction locally: %r" % e)
+
+    if any(prd):
+        try:
+            predictionAccuracy.writeSeries(client, 'prediction', today, prd)
+        except Exception as e:
+            print("Failed to store prediction: %r" % e)
+        planSwitchSocket(prediction=prd, sched=sched, plan_type=plan_type)
+    else:   # run base like when dif days < 14
+        baseSwitching(sched=sched)
 
 
 # ===================================== #
@@ -596,27 +686,41 @@ def makeForecast(sched):
 
 # Constants
 plugIP = "192.168.1.100"  # change to Your socket IP
-tank_volume = 80  # change to Your tank volume [l]
-heater_power = 2400  # change to Your tank heater power [W]
-
-avr_cold_H2O_temp = 8.7  # [C]
-normal_H2O_temp = 37  # [C]
-thermal_capacity_H2O = 4175  # at 40 degrees
-limit_tank_temp = 40  # [C]
-eta = 0.98  # heater effectivity
+mqttServerIP = '192.168.1.105'  # change to Your MQTT IP
+mqttTopic = 'sensors'
+slot_minutes = 15  # length of prediction and planning interval [min]
+query_timeout = 10  # [s] timeout of single Influxdb request
+planning_budget = 120  # [s] time after which fallback prediction is used
+forecast_cache_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'forecastCache.json')
+# tank and heater constants are set in waterPhysics.py
 
 # Initialize database connection
-client = influxdb.InfluxDBClient(host='localhost', port=8086, username='telegraf', password='telegraf',
-                                 database='sensors')
+client = dbGuard.GuardedClient(influxdb.InfluxDBClient(host='localhost', port=8086, username='telegraf',
+                                                       password='telegraf', database='sensors',
+                                                       timeout=query_timeout, retries=1))
 # Initialize smart plug
 plug = kasa.SmartPlug(plugIP)
 
-# Initialize scheduler and plan main events
-scheduler = BackgroundScheduler()
-scheduler.start()
-scheduler.add_job(func=makeForecast, args=[scheduler], trigger='cron', hour='0', minute='15')
-scheduler.add_job(func=checkLimitTemp, args=[scheduler], trigger='interval', minutes=5)
-
-# Infinite loop for continuous script run
-while True:
-    time.sleep(1)
+if __name__ == '__main__':
+    syncPlugState()
+
+    # Follow power readings of the plug to keep plug state cache up to date, cache is optional so controller runs
+    # while broker is down and client keeps reconnecting in background
+    mqttClient = mqtt.Client(client_id='smartBoiler')
+    mqttClient.on_connect = onMqttConnect
+    mqttClient.on_message = plugState.onMessage
+    mqttClient.connect_async(mqttServerIP)
+    mqttClient.loop_start()
+
+    # Initialize scheduler and plan main events
+    scheduler = BackgroundScheduler()
+    scheduler.start()
+    scheduler.add_job(func=makeForecast, args=[scheduler], trigger='cron', hour='0', minute='15')
+    scheduler.add_job(func=checkLimitTemp, args=[scheduler], trigger='interval', minutes=5)
+    scheduler.add_job(func=reportEnergy, trigger='cron', hour='0', minute='30')
+    scheduler.add_job(func=evaluatePredictions, trigger='cron', hour='0', minute='45')
+    scheduler.add_job(func=syncPlugState, trigger='interval', minutes=10)
+
+    # Infinite loop for continuous script run
+    while True:
+        time.sleep(1)
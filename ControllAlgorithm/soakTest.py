@@ -0,0 +1,341 @@
+"""
+Soak test of SmartBoiler control algorithm. Runs controller functions against fake Influxdb and fake smart plug on
+virtual clock, one simulated minute per step, for simulated months. Periodically takes tracemalloc, thread, file
+descriptor and scheduled job snapshots and fails when any of them keeps growing.
+
+Usage: python3 soakTest.py [--days 90] [--snapshot-days 7] [--warmup-days 30] [--outage-days 10]
+
+author: J.Mitura (xmitur01)
+version: 1.0
+"""
+import argparse
+import contextlib
+import functools
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import dbGuard
+import smartBoiler
+from energyReport import dayToEpoch
+
+
+clock = {'now': datetime(2021, 1, 1)}
+
+
+class VirtualDatetime(datetime):
+    """Datetime with now() following virtual clock of soak test."""
+
+    @classmethod
+    def now(cls, tz=None):
+        return clock['now']
+
+
+class FakeResult:
+    """Minimal stand-in for Influxdb ResultSet."""
+
+    def __init__(self, points):
+        self.points = points
+
+    def get_points(self, measurement=None):
+        return iter(self.points)
+
+
+class FakeInfluxDB:
+    """Stand-in for InfluxDBClient generating daily temperature series with usage at 7am and 7pm. Written points are
+    only counted, except stored series of predictions and usage profiles."""
+
+    stored_measurements = ('usage_profile', 'prediction')
+
+    def __init__(self, first_date):
+        self.first_date = first_date
+        self.written = 0
+        self.series = {name: {} for name in self.stored_measurements}
+        self.evaluated = None   # epoch seconds of last prediction error record
+        self.down = False
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def dayData(day):
+        """Generate one minute pipe and tank temperature series of given day.
+
+        :param day: string date YYYY-MM-DD
+        :return: tuple[list of pipe points, list of tank points]
+        """
+        pipe, tank = [], []
+        start = datetime.strptime(day, '%Y-%m-%d')
+        for m in range(24 * 60):
+            ts = (start + timedelta(minutes=m)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            k = m - 420 if 420 <= m < 440 else (m - 1140 if 1140 <= m < 1170 else None)
+            if k is None:
+                pv, tv = 20.0, 50.0
+            elif k < 10:
+                pv, tv = 40 - k * 0.5, 50 - k * 0.2
+            else:
+                pv, tv = 35 + (k - 10) * 0.5, 48.0
+            pipe.append({'time': ts, 'value': pv})
+            tank.append({'time': ts, 'value': tv})
+
+        return pipe, tank
+
+    def query(self, q, bind_params=None, epoch=None):
+        if self.down:
+            raise ConnectionError("simulated Influxdb outage")
+        now = clock['now']
+        if 'first(' in q:
+            return FakeResult([{'time': self.first_date + 'T00:00:00Z', 'first': 50.0}])
+        if 'last(' in q and 'temp_tank' in q:
+            low = now.hour == 5 and now.minute < 30  # falls below limit every morning
+            return FakeResult([{'time': now.strftime('%Y-%m-%dT%H:%M:%SZ'), 'last': 36.0 if low else 45.0}])
+        if 'prediction_error' in q:
+            return FakeResult([{'time': self.evaluated, 'last': 1.0}] if self.evaluated is not None else [])
+        for name in self.stored_measurements:
+            if 'FROM %s ' % name in q:
+                start = dayToEpoch(bind_params['start_time'][:10])
+                end = dayToEpoch(bind_params['end_time'][:10]) + 86400
+                return FakeResult([{'time': day + i * 900, 'value': v}
+                                   for day, row in self.series[name].items() if start <= day < end
+                                   for i, v in enumerate(row.tolist())])
+        if 'count(' in q:
+            return FakeResult([{'count': 1440}, {'count': 1440}])
+        if 'temp_pipe' in q or 'temp_tank' in q:
+            pipe, tank = self.dayData(bind_params['start_time'][:10])
+            return FakeResult(pipe if 'temp_pipe' in q else tank)
+        if 'FROM power' in q:
+            start = dayToEpoch(bind_params['start_time'][:10])
+            return FakeResult([{'time': start + s, 'value': 2400.0 if 3600 <= s < 7200 else 0.0}
+                               for s in range(0, 86400, 60)])
+
+        return FakeResult([])
+
+    def write_points(self, points, **kwargs):
+        if self.down:
+            raise ConnectionError("simulated Influxdb outage")
+        self.written += len(points)
+        for point in points:
+            if point['measurement'] in self.series:   # kept as arrays allocated here, excluded from traced memory
+                day = point['time'] - point['time'] % 86400
+                row = self.series[point['measurement']].setdefault(day, np.zeros(96))
+                row[(point['time'] - day) // 900] = point['fields']['value']
+            elif point['measurement'] == 'prediction_error':
+                self.evaluated = max(self.evaluated or 0, point['time'])
+
+
+class FakePlug:
+    """Stand-in for kasa.SmartPlug."""
+
+    def __init__(self):
+        self.is_on = False
+        self.commands = 0
+
+    async def turn_on(self):
+        self.is_on = True
+        self.commands += 1
+
+    async def turn_off(self):
+        self.is_on = False
+        self.commands += 1
+
+    async def update(self):
+        pass
+
+
+class FakeScheduler:
+    """Stand-in for APScheduler running jobs on virtual clock. Date jobs with run time already passed are dropped like
+    APScheduler misfires them."""
+
+    def __init__(self):
+        self.jobs = []
+        self.missed = 0
+
+    def add_job(self, func, args=None, trigger='date', next_run_time=None, id=None, replace_existing=False, **kwargs):
+        run_time = datetime.strptime(str(next_run_time), '%Y-%m-%d %H:%M:%S')
+        if id is not None and replace_existing:
+            self.jobs = [job for job in self.jobs if job[3] != id]
+        if run_time < clock['now'] - timedelta(seconds=1):
+            self.missed += 1
+            return
+        self.jobs.append((run_time, func, args or [], id))
+
+    def runPending(self):
+        """Run and remove jobs which are due."""
+        due = [job for job in self.jobs if job[0] <= clock['now']]
+        self.jobs = [job for job in self.jobs if job[0] > clock['now']]
+        for _, func, args, _ in due:
+            func(*args)
+
+
+def countFds():
+    """Count open file descriptors of the process.
+
+    :return: int number of descriptors or -1 when not available
+    """
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return -1
+
+
+def tracedMemory():
+    """Sum memory traced by tracemalloc, without allocations made by the fakes of this test.
+
+    :return: int memory in bytes
+    """
+    traces = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__)])
+
+    return sum(stat.size for stat in traces.statistics('filename'))
+
+
+def snapshot(sched):
+    """Take snapshot of resources used by the process.
+
+    :param sched: FakeScheduler object
+    :return: dictionary{day, memory, threads, fds, jobs}
+    """
+    return {'day': str(clock['now'].date()),
+            'memory': tracedMemory(),
+            'threads': threading.active_count(),
+            'fds': countFds(),
+            'jobs': len(sched.jobs)}
+
+
+def checkGrowth(snapshots, warmup_snapshots, max_memory_growth, max_jobs):
+    """Compare snapshots with the first one after warm up and list resources which grow.
+
+    :param snapshots: list of snapshot dictionaries
+    :param warmup_snapshots: int number of snapshots taken during warm up, not used as baseline
+    :param max_memory_growth: int allowed growth of traced memory in bytes
+    :param max_jobs: int allowed number of pending jobs
+    :return: list of strings describing failures
+    """
+    base = snapshots[min(warmup_snapshots, len(snapshots) - 1)]
+    last = snapshots[-1]
+    failures = []
+
+    if last['memory'] - base['memory'] > max_memory_growth:
+        failures.append("memory grew by %d B" % (last['memory'] - base['memory']))
+    if last['threads'] > base['threads']:
+        failures.append("threads grew from %d to %d" % (base['threads'], last['threads']))
+    if last['fds'] > base['fds']:
+        failures.append("file descriptors grew from %d to %d" % (base['fds'], last['fds']))
+    if max(s['jobs'] for s in snapshots) > max_jobs:
+        failures.append("pending jobs reached %d" % max(s['jobs'] for s in snapshots))
+
+    return failures
+
+
+def checkFirstSlotUsage(db, plug, quiet):
+    """Plan day at 00:15 with predicted usage in the first or second interval, whose turn off time already passed.
+    Plug must not be left on without pending turn off.
+
+    :param db: FakeInfluxDB object
+    :param plug: FakePlug object
+    :param quiet: file object for controller prints
+    :return: list of strings describing failures
+    """
+    failures = []
+    db.down = False
+
+    for first_use in (0, 1):
+        sched = FakeScheduler()
+        clock['now'] = datetime.combine(clock['now'].date() + timedelta(days=1), datetime.min.time()) \
+            + timedelta(minutes=15)
+        plug.is_on = False
+        prediction = [0.0] * 96
+        prediction[first_use] = 5.0
+
+        with contextlib.redirect_stdout(quiet):
+            smartBoiler.syncPlugState()
+            smartBoiler.planSwitchSocket(prediction, sched)
+
+        if plug.is_on and not any(job[1] is smartBoiler.turnOff for job in sched.jobs):
+            failures.append("usage in interval %d left plug on without turn off" % first_use)
+        if sched.missed:
+            failures.append("usage in interval %d missed %d jobs" % (first_use, sched.missed))
+
+    return failures
+
+
+def run(args):
+    """Run controller on virtual clock for given number of days and check resource usage.
+
+    :param args: parsed command line arguments
+    :return: int exit code, 0 when no growth detected
+    """
+    start = clock['now']
+    db = FakeInfluxDB(first_date=str(start.date()))
+    plug = FakePlug()
+    sched = FakeScheduler()
+    quiet = open(os.devnull, 'w')  # controller prints plug state every 10 minutes
+
+    cache_dir = tempfile.TemporaryDirectory()
+    smartBoiler.datetime = VirtualDatetime
+    smartBoiler.client = dbGuard.GuardedClient(db, reset_timeout=0)  # no real time passes on virtual clock
+    smartBoiler.plug = plug
+    smartBoiler.forecast_cache_file = os.path.join(cache_dir.name, 'forecastCache.json')
+
+    tracemalloc.start()
+    snapshots = []
+    warmup_snapshots = 0
+
+    for minute in range(args.days * 24 * 60):
+        now = start + timedelta(minutes=minute)
+        clock['now'] = now
+        db.down = args.outage_days > 0 and (minute // (24 * 60)) % args.outage_days == args.outage_days - 1
+
+        with contextlib.redirect_stdout(quiet):
+            if now.hour == 0 and now.minute == 15:
+                smartBoiler.makeForecast(sched)
+            if now.hour == 0 and now.minute == 30:
+                smartBoiler.reportEnergy()
+            if now.hour == 0 and now.minute == 45:
+                smartBoiler.evaluatePredictions()
+            if now.minute % 5 == 0:
+                smartBoiler.checkLimitTemp(sched)
+            if now.minute % 10 == 0:
+                smartBoiler.syncPlugState()
+            sched.runPending()
+
+        if now.hour == 12 and now.minute == 0 and (minute // (24 * 60)) % args.snapshot_days == 0:
+            snapshots.append(snapshot(sched))
+            print(snapshots[-1])
+            if minute < args.warmup_days * 24 * 60:
+                warmup_snapshots += 1
+
+    tracemalloc.stop()
+    failures = checkGrowth(snapshots, warmup_snapshots, args.max_memory_growth, args.max_jobs)
+    failures += checkFirstSlotUsage(db, plug, quiet)
+    quiet.close()
+    cache_dir.cleanup()
+
+    print("Simulated %d days, plug commands: %d, points written: %d, missed jobs: %d, last evaluated day: %s"
+          % (args.days, plug.commands, db.written, sched.missed,
+             None if db.evaluated is None else (datetime(1970, 1, 1) + timedelta(seconds=db.evaluated)).date()))
+    for failure in failures:
+        print("FAIL: " + failure)
+    if not failures:
+        print("OK: no resource growth detected")
+
+    return 1 if failures else 0
+
+
+# ===================================== #
+#                 MAIN                  #
+# ===================================== #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SmartBoiler controller soak test")
+    parser.add_argument('--days', type=int, default=90, help="number of simulated days")
+    parser.add_argument('--snapshot-days', type=int, default=7, help="days between resource snapshots")
+    parser.add_argument('--warmup-days', type=int, default=30,
+                        help="days before baseline snapshot, prediction uses 4 weeks of history from day 29")
+    parser.add_argument('--max-memory-growth', type=int, default=1024 * 1024, help="allowed memory growth [B]")
+    parser.add_argument('--outage-days', type=int, default=10, help="every N-th day Influxdb is down, 0 disables")
+    parser.add_argument('--max-jobs', type=int, default=20, help="allowed number of pending scheduled jobs")
+
+    sys.exit(run(parser.parse_args()))
@@ -0,0 +1,252 @@
+"""
+Thermal calculations used by SmartBoiler control algorithm. All conversions accept single numbers as well as NumPy
+arrays, so they can be used per event in the controller and over long series in backtests and backfills.
+
+author: J.Mitura (xmitur01)
+version: 1.0
+"""
+import numpy as np
+
+
+# ===================================== #
+#               CONSTANTS               #
+# ===================================== #
+
+tank_volume = 80  # change to Your tank volume [l]
+heater_power = 2400  # change to Your tank heater power [W]
+
+avr_cold_H2O_temp = 8.7  # [C]
+normal_H2O_temp = 37  # [C]
+thermal_capacity_H2O = 4175  # at 40 degrees
+limit_tank_temp = 40  # [C]
+eta = 0.98  # heater effectivity
+
+# calculations based on experiment, used due to lack of analog thermometer shaft on tank, accurate in range 40 to 70 deg
+wrap_ref_temp = 42  # sensor temperature where wrap_diff was measured
+wrap_diff = 13.5  # difference between tank wrap and water temperature at when sensor at 42 deg
+wrap_diff_change = 0.525  # diff change per 0.1 change on sensor
+wrap_water_change = 0.625  # water temperature change per 0.1 change on sensor
+wrap_air_temp = 38  # below this sensor temperature air temperature plays more significant role
+
+lookup_resolution = 0.1  # [C] step of precomputed lookup tables
+lookup_min_temp = 0  # [C]
+lookup_max_temp = 100  # [C]
+
+
+def toScalar(value):
+    """Convert zero dimensional array back to float, so scalar callers keep getting plain numbers.
+
+    :param value: numpy array or number
+    :return: float for scalar input, otherwise unchanged array
+    """
+    if np.ndim(value) == 0:
+        return float(value)
+
+    return value
+
+
+# Calculations
+def heatEnergy(desired_temp, actual_temp, volume=tank_volume):
+    """Calculate heat energy based on temperature difference.
+
+    :param desired_temp: float number or array
+    :param actual_temp: float number or array
+    :param volume: float tank volume in liters
+    :return: float heat or array
+    """
+    q = volume * thermal_capacity_H2O * (np.asarray(desired_temp, dtype=float) - np.asarray(actual_temp, dtype=float))
+
+    return toScalar(q)
+
+
+def timeTillHeated(desired_temp, actual_temp, volume=tank_volume):
+    """Calculate time needed to heat water on specific temperature. Using heater power and eta.
+
+    :param desired_temp: float number or array
+    :param actual_temp: float number or array
+    :param volume: float tank volume in liters
+    :return: float time in minutes or array
+    """
+    t = heatEnergy(desired_temp, actual_temp, volume=volume) / (heater_power * eta)
+
+    return toScalar(t / 60)
+
+
+def calculateUsedWater(temp_tank_before, temp_tank_after, volume=tank_volume):
+    """Calculate amount of used water based on temperature change and tank volume.
+
+    :param temp_tank_before: float number or array
+    :param temp_tank_after: float number or array
+    :param volume: float tank volume in liters
+    :return: float used water volume in liters or array
+    """
+    before = np.asarray(temp_tank_before, dtype=float)
+    after = np.asarray(temp_tank_after, dtype=float)
+    used_w = (volume * (after - before)) / (avr_cold_H2O_temp - before)
+
+    return toScalar(used_w)
+
+
+def normalizeUsedWater(temp_tank_before, temp_tank_after, used_volume):
+    """Calculate amount of used water with normalized temperature 37deg of C
+
+    :param temp_tank_before: float number or array
+    :param temp_tank_after: float number or array
+    :param used_volume: float volume in liters or array
+    :return: float used water in liters or array
+    """
+    before = np.asarray(temp_tank_before, dtype=float)
+    used = np.asarray(used_volume, dtype=float)
+
+    normalized_usage = used + ((used * (before - normal_H2O_temp)) / (normal_H2O_temp - avr_cold_H2O_temp))
+
+    return toScalar(normalized_usage)
+
+
+def calculateMaxProductionCapability(actual_tank_temp, volume=tank_volume):
+    """Calculate maximum available water volume when using water of temperature 37deg of C
+
+    :param actual_tank_temp: float number or array
+    :param volume: float tank volume in liters
+    :return: float available water in liters or array
+    """
+    actual = np.asarray(actual_tank_temp, dtype=float)
+    max_prod = volume + (volume * (actual - normal_H2O_temp) / (normal_H2O_temp - avr_cold_H2O_temp))
+
+    return toScalar(max_prod)
+
+
+def minTankTemp(water_usage, volume=tank_volume, limit_temp=limit_tank_temp):
+    """Calculate minimum tank temperature which satisfies predicted usage of water of temperature 37deg of C
+
+    :param water_usage: float number or array
+    :param volume: float tank volume in liters
+    :param limit_temp: float lowest allowed water temperature in deg of C
+    :return: float number temp in deg of C or array
+    """
+    usage = np.asarray(water_usage, dtype=float)
+    min_temp = ((limit_temp * volume) - (avr_cold_H2O_temp * usage)) / (volume - usage)
+
+    return toScalar(min_temp)
+
+
+def wrapTempToWater(wrap_temp):
+    """Calculates actual temperature of water in tank based on single wrap temperature reading.
+
+    :param wrap_temp: float number or array
+    :return: float number temp in deg of C or array
+    """
+    temp = np.asarray(wrap_temp, dtype=float)
+    real = temp + wrap_diff + (temp - wrap_ref_temp) * 10 * wrap_diff_change
+    real = np.where(temp < wrap_air_temp, temp, real)  # air temperature plays more significant role
+
+    return toScalar(real)
+
+
+def wrapTempToWaterTemp(temp_before, temp_after):
+    """Calculates actual temperature of water in tank based on wrap temperature.
+
+    :param temp_before: float number or array
+    :param temp_after: float number or array
+    :return: tuple[float number temp in deg of C, float number temp in deg of C] or tuple of arrays
+    """
+    before = np.asarray(temp_before, dtype=float)
+    after = np.asarray(temp_after, dtype=float)
+
+    real_before = wrapTempToWater(before)
+    real_after = real_before + (after - before) * 10 * wrap_water_change
+
+    return real_before, toScalar(real_after)
+
+
+# Lookup tables
+def buildLookupTable(resolution=lookup_resolution, min_temp=lookup_min_temp, max_temp=lookup_max_temp,
+                     volume=tank_volume):
+    """Precompute wrap to water temperature conversion and heating time for temperature grid with given resolution.
+    Heating time is stored cumulatively from min_temp, so time between any two temperatures is a difference of two
+    table values.
+
+    :param resolution: float grid step in deg of C
+    :param min_temp: float lowest temperature of grid
+    :param max_temp: float highest temperature of grid
+    :param volume: float tank volume in liters
+    :return: dictionary{min_temp:float, resolution:float, temp:array, water_temp:array, heating_minutes:array}
+    """
+    n = int(round((max_temp - min_temp) / resolution)) + 1
+    grid = min_temp + np.arange(n) * resolution
+
+    return {'min_temp': float(min_temp),
+            'resolution': float(resolution),
+            'temp': grid,
+            'water_temp': wrapTempToWater(grid),
+            'heating_minutes': timeTillHeated(grid, min_temp, volume=volume)}
+
+
+def lookupIndex(table, temp):
+    """Convert temperatures to nearest indexes of lookup table grid, values outside of grid are clipped.
+
+    :param table: dictionary created by buildLookupTable
+    :param temp: float number or array
+    :return: int index or array of indexes
+    """
+    index = np.rint((np.asarray(temp, dtype=float) - table['min_temp']) / table['resolution'])
+
+    return np.clip(index, 0, len(table['temp']) - 1).astype(np.intp)
+
+
+def lookupWaterTemp(table, wrap_temp):
+    """Convert wrap temperature to water temperature using precomputed lookup table.
+
+    :param table: dictionary created by buildLookupTable
+    :param wrap_temp: float number or array
+    :return: float number temp in deg of C or array
+    """
+    return toScalar(table['water_temp'][lookupIndex(table, wrap_temp)])
+
+
+def lookupTimeTillHeated(table, desired_temp, actual_temp):
+    """Time needed to heat water on specific temperature using precomputed lookup table.
+
+    :param table: dictionary created by buildLookupTable
+    :param desired_temp: float number or array
+    :param actual_temp: float number or array
+    :return: float time in minutes or array
+    """
+    minutes = table['heating_minutes']
+
+    return toScalar(minutes[lookupIndex(table, desired_temp)] - minutes[lookupIndex(table, actual_temp)])
+
+
+# Calibration
+def calibrateWrapCoefficients(wrap_temps, water_temps):
+    """Fit wrap temperature coefficients to recorded pairs of wrap sensor and real water temperatures using least
+    squares. Pairs with wrap temperature below wrap_air_temp are ignored, for them air temperature dominates.
+    Water change coefficient is fitted on changes between consecutive records, both of them above wrap_air_temp.
+
+    :param wrap_temps: list or array of wrap sensor temperatures
+    :param water_temps: list or array of measured water temperatures
+    :return: tuple[float diff, float diff_change, float water_change] usable as wrap_diff, wrap_diff_change
+             and wrap_water_change
+    """
+    all_wrap = np.asarray(wrap_temps, dtype=float)
+    all_water = np.asarray(water_temps, dtype=float)
+    mask = all_wrap >= wrap_air_temp
+    wrap = all_wrap[mask]
+    water = all_water[mask]
+
+    if len(wrap) < 2:
+        raise ValueError("At least two records above %s deg of C needed for calibration." % wrap_air_temp)
+
+    # water = wrap + diff + (wrap - ref) * 10 * diff_change  ->  water - wrap = a * (wrap - ref) + diff
+    design = np.column_stack([wrap - wrap_ref_temp, np.ones_like(wrap)])
+    (a, diff), _, _, _ = np.linalg.lstsq(design, water - wrap, rcond=None)
+    diff_change = a / 10
+
+    # water change per 0.1 change on sensor, fitted through origin, records around removed ones are not consecutive
+    pairs = mask[1:] & mask[:-1]
+    d_wrap = np.diff(all_wrap)[pairs] * 10
+    d_water = np.diff(all_water)[pairs]
+    denominator = np.dot(d_wrap, d_wrap)
+    water_change = np.dot(d_wrap, d_water) / denominator if denominator else wrap_water_change
+
+    return float(diff), float(diff_change), float(water_change)
@@ -11,7 +11,8 @@ import gc
 import onewire
 import ds18x20
 import esp
-from struct import unpack
+import ntptime
+from struct import unpack, pack_into
 
 import boot
 
@@ -22,6 +23,18 @@ mqttServerIP = '192.168.1.105'  # change to Your MQTT server IP
 lastMessage = 0
 messageInterval = 5
 
+payloadFormat = 'text'  # 'text' line protocol message per sensor or 'binary' compact frames, see sensorBridge.py
+mqttBinaryTopic = 'sensors/bin'
+frameCycles = 6  # number of read cycles stored in one binary frame
+maxSensors = 2
+frameHeaderSize = 3  # uint8 magic, uint8 version, uint8 readings count
+readingSize = 7  # uint8 sensor id, uint32 seconds since 2000-01-01, int16 temperature in 0.01 deg of C
+frame = bytearray(frameHeaderSize + readingSize * maxSensors * frameCycles)
+frameReadings = 0
+frameCycle = 0
+timeSyncInterval = 3600  # [s] RTC drifts, binary frames carry time of reading
+lastTimeSync = 0
+
 
 def connectMQTT():
     """Make connection with MQTT server and print message on serial output for debug."""
@@ -92,10 +105,57 @@ def readSensor():
         restartAndReconnect()
 
 
+def syncTime():
+    """Set RTC from NTP server, next synchronization is tried after timeSyncInterval also when this one failed.
+
+    :return: bool True when time was synchronized
+    """
+    global lastTimeSync
+
+    lastTimeSync = time.ticks_ms()
+    try:
+        ntptime.settime()
+        return True
+    except OSError:
+        print("Failed to synchronize time.")
+        return False
+
+
+def addReading(name, temp):
+    """Pack sensor reading into binary frame buffer, buffer is preallocated to avoid heap allocations.
+
+    :param name: string sensor name pipe or tank
+    :param temp: string temperature in xxx.x format
+    """
+    global frameReadings
+
+    if frameReadings >= maxSensors * frameCycles:
+        return
+
+    offset = frameHeaderSize + frameReadings * readingSize
+    pack_into('<BIh', frame, offset, 0 if name == "pipe" else 1, time.time(), round(float(temp) * 100))
+    frameReadings += 1
+
+
+def publishFrame():
+    """Publish binary frame with collected readings and reset frame buffer."""
+    global frameReadings, frameCycle
+
+    if frameReadings:
+        pack_into('<BBB', frame, 0, 0xB1, 1, frameReadings)
+        client.publish(mqttBinaryTopic, memoryview(frame)[:frameHeaderSize + frameReadings * readingSize])
+
+    frameReadings = 0
+    frameCycle = 0
+
+
 def publish():
     """In 5 second intervals run main automata cycle(check connection, read sensor data, publish via MQTT).
     Tries to publish sensor data, if error occurs restart machine and reconnect.
+    With binary payload format readings of several cycles are published in one frame.
     """
+    global frameCycle
+
     while True:
         try:
             checkWifi()
@@ -104,12 +164,23 @@ def publish():
 
             for data in sensors_data:
                 print(data)
-                name = "temp_pipe" if data[0] == "pipe" else "temp_tank"
 
-                msg = b'%s,site=%s value=%s' % (name, data[0], data[1])
-                client.publish(mqttPublishTopic, msg)
+                if payloadFormat == 'binary':
+                    addReading(data[0], data[1])
+                else:
+                    name = "temp_pipe" if data[0] == "pipe" else "temp_tank"
+
+                    msg = b'%s,site=%s value=%s' % (name, data[0], data[1])
+                    client.publish(mqttPublishTopic, msg)
                 counter += 1
 
+            if payloadFormat == 'binary':
+                frameCycle += 1
+                if frameCycle >= frameCycles:
+                    publishFrame()
+                    if time.ticks_diff(time.ticks_ms(), lastTimeSync) >= timeSyncInterval * 1000:
+                        syncTime()   # between frames, so readings of one frame share the same clock
+
             time.sleep(messageInterval)
         except OSError:
             restartAndReconnect()
@@ -126,6 +197,11 @@ ds_pin = machine.Pin(4)     # GPIO pin with sensors connected
 ds_sensor = ds18x20.DS18X20(onewire.OneWire(ds_pin))    # initialize for communication via one wire protocol
 client = MQTTClient(clientID, mqttServerIP)
 
+# Binary frames carry time of reading, use text format when time can't be synchronized
+if payloadFormat == 'binary' and not syncTime():
+    print("Using text payload format.")
+    payloadFormat = 'text'
+
 # Try to create connection with MQTT server
 try:
     connectMQTT()
@@ -1,8 +1,10 @@
 """
-Implementation of power usage monitoring service. Used with socket Tp-Link HS110
+Implementation of power usage monitoring service. Used with sockets Tp-Link HS110, one process monitors all plugs.
+Plugs are polled concurrently in one event loop with per device timeout, readings of each tick are published in one
+MQTT message. New plugs can be added by network discovery.
 
 author: J.Mitura (xmitur01)
-version: 1.0
+version: 1.1
 """
 import kasa
 import time
@@ -12,14 +14,53 @@ import os
 import sys
 
 
-def getEnergyUsage():
-    """Query plug for energy usage data. Runs as async task.
+async def updatePlug(ip, plug):
+    """Load plug state, needed before energy meter can be read. Limited by plugTimeout, plug which failed is tried
+    again in next tick.
 
-    :return: json with device energy data
+    :param ip: string plug IP
+    :param plug: smart plug object
+    :return: bool True when plug was updated
     """
-    energy_data = asyncio.run(plug.get_emeter_realtime())
+    try:
+        await asyncio.wait_for(plug.update(), timeout=plugTimeout)
+    except Exception as e:   # one failing plug must not stop polling of the others
+        print("Failed to update plug %s: %r" % (ip, e))
+        return False
+
+    updated.add(ip)
+    return True
+
+
+async def getEnergyUsage(ip, plug):
+    """Query plug for energy usage data, limited by plugTimeout.
+
+    :param ip: string plug IP
+    :param plug: smart plug object
+    :return: json with device energy data or None when plug doesn't respond
+    """
+    try:
+        return await asyncio.wait_for(plug.get_emeter_realtime(), timeout=plugTimeout)
+    except Exception as e:   # one failing plug must not stop polling of the others
+        print("Failed to read energy meter of plug %s: %r" % (ip, e))
+        return None
 
-    return energy_data
+
+async def discoverPlugs():
+    """Search network for plugs with energy meter and add new ones to monitored plugs. Site of new plug is its alias.
+    """
+    try:
+        found = await kasa.Discover.discover(timeout=plugTimeout)
+    except Exception as e:   # discovery is retried in next interval
+        print("Plug discovery failed: %r" % e)
+        return
+
+    for ip, device in found.items():
+        if ip not in plugs and device.is_plug and device.has_emeter:
+            site = device.alias.replace(' ', '_').replace(',', '_') or ip
+            plugs[ip] = (device, site)
+            print("Discovered plug %s at %s" % (site, ip))
+            await updatePlug(ip, device)
 
 
 def connectMQTT():
@@ -27,6 +68,7 @@ def connectMQTT():
     """
     try:
         mqttClient.connect(mqttServerIP)
+        mqttClient.loop_start()
         print("Connected to %s MQTT broker" % mqttServerIP)
     except OSError:
         print("Failed to connect to MQTT broker. Restarting and reconnecting.")
@@ -34,46 +76,86 @@ def connectMQTT():
 
 
 def initialize():
-    """Initialize MQTT client and smart plug device instance
+    """Initialize MQTT client and smart plug device instances, plugs are updated in first tick of publish loop.
 
     :return: tuple[MQTT client object,
-             smart plug object]
+             dictionary{ip: tuple[smart plug object, string site]}]
     """
     client = mqtt.Client(client_id=clientID)
-
-    p = kasa.SmartPlug(plugIP)
-    asyncio.run(p.update())
+    p = {ip: (kasa.SmartPlug(ip), site) for ip, site in plugSites.items()}
 
     return client, p
 
 
-def sentPayload(name, site, value):
-    """Publishes message on MQTT server.
+def createPayload(name, site, value):
+    """Create line protocol record.
 
     :param name: string record name
     :param site: string location
-    :param value: float wat hours
+    :param value: float number
+    :return: string record
     """
-    payload = name + ',site=%s value=%s' % (site, value)
-    mqttClient.publish(topic=mqttPublishTopic, payload=payload)
+    return name + ',site=%s value=%s' % (site, value)
+
 
+async def pollPlug(ip, plug):
+    """Poll one plug, plug which was not updated yet is updated first. Each plug is polled in its own coroutine, so
+    offline plug doesn't delay the others.
 
-def publish():
-    """Main script cycle(check connection, get data, send sata).
-    Every 5 seconds tries to send data with energy consumption and actual power state on MQTT server
-    if connection is up.
+    :param ip: string plug IP
+    :param plug: smart plug object
+    :return: json with device energy data or None when plug doesn't respond
     """
-    while True:
-        mqttClient.reconnect()
+    if ip not in updated and not await updatePlug(ip, plug):
+        return None
 
-        energy_data = getEnergyUsage()
+    return await getEnergyUsage(ip, plug)
+
+
+async def collect():
+    """Poll all plugs concurrently.
+
+    :return: list of string records with power and total energy of plugs which responded
+    """
+    devices = list(plugs.items())
+    results = await asyncio.gather(*(pollPlug(ip, plug) for ip, (plug, _) in devices))
+
+    records = []
+    for (_, (_, site)), energy_data in zip(devices, results):
+        if energy_data is None:
+            continue
         wats = float(energy_data['power_mw']) / 1000
         wat_hours = float(energy_data['total_wh'])
 
-        sentPayload(name="power", site="bathroom", value=wats)
-        sentPayload(name="energy_total", site="bathroom", value=wat_hours)
+        records.append(createPayload(name="power", site=site, value=wats))
+        records.append(createPayload(name="energy_total", site=site, value=wat_hours))
+
+    return records
+
+
+async def discoverPeriodically():
+    """Search network for new plugs every discoveryInterval, runs as background task beside polling."""
+    while True:
+        await discoverPlugs()
+        await asyncio.sleep(discoveryInterval)
+
+
+async def publish():
+    """Main script cycle(get data, send data). Every 5 seconds polls all plugs and publishes their energy consumption
+    and actual power state in one message on MQTT server. Network is searched for new plugs in background task.
+    """
+    discovery = asyncio.create_task(discoverPeriodically()) if useDiscovery else None   # keep task referenced
+    next_tick = time.monotonic()
+
+    while True:
+        records = await collect()
+        if records:
+            mqttClient.publish(topic=mqttPublishTopic, payload='\n'.join(records))
 
-        time.sleep(updateInterval)
+        next_tick += updateInterval
+        if next_tick < time.monotonic():   # tick overran, don't catch up with back to back ticks
+            next_tick = time.monotonic()
+        await asyncio.sleep(next_tick - time.monotonic())
 
 
 # ===================================== #
@@ -84,10 +166,14 @@ mqttPublishTopic = 'sensors'
 clientID = 'HS110_boiler'
 mqttServerIP = '192.168.1.105'  # change to Your MQTT IP
 updateInterval = 5
+plugTimeout = 3  # [s] plug which doesn't respond in time is skipped in actual tick
 
-plugIP = "192.168.1.100"    # change to Your socket IP
+plugSites = {"192.168.1.100": "bathroom"}    # change to Your socket IP, add other plugs as "ip": "site"
+useDiscovery = False  # search network for other plugs with energy meter
+discoveryInterval = 300  # [s]
 
-mqttClient, plug = initialize()
+mqttClient, plugs = initialize()
+updated = set()  # IPs of plugs which were successfully updated
 connectMQTT()
 
-publish()
+asyncio.run(publish())
@@ -0,0 +1,271 @@
+"""
+Load test of SmartBoiler server components(MQTT broker -> Telegraf -> Influxdb). Simulates fleet of NodeMCU ESP8266
+sensor nodes and HS110 plugs publishing the same line protocol messages as ESP8266/main.py and HS110/energyUsage.py
+and measures end to end ingest latency, dropped messages and latency of controller queries while load runs.
+
+Simulated devices use their own site tag(loadtest-esp-01, loadtest-plug-01, ...). Controller queries do not filter
+by site, so simulated series and probes are dropped after the test(unless --keep-data is set), prefer test server.
+
+Usage: python3 loadTest.py --nodes 20 --plugs 20 --duration 300
+
+author: J.Mitura (xmitur01)
+version: 1.0
+"""
+import argparse
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import influxdb
+import numpy as np
+import paho.mqtt.client as mqtt
+
+
+mqttPublishTopic = 'sensors'
+probeMeasurement = 'loadtest_probe'
+
+
+# Simulated devices
+def espPayloads(site, temps):
+    """Create messages in the same format as ESP8266/main.py.
+
+    :param site: string device site tag
+    :param temps: dictionary{sensor name: float temperature}
+    :return: list of bytes messages
+    """
+    msgs = []
+    for sensor, temp in temps.items():
+        name = "temp_pipe" if sensor == "pipe" else "temp_tank"
+        msgs.append(b'%s,site=%s value=%s' % (name.encode(), (site + "-" + sensor).encode(),
+                                              ('{0:3.1f}'.format(temp)).encode()))
+
+    return msgs
+
+
+def plugPayloads(site, wats, wat_hours):
+    """Create records in the same format as HS110/energyUsage.py.
+
+    :param site: string device site tag
+    :param wats: float actual power
+    :param wat_hours: float total energy
+    :return: list of string records
+    """
+    return ["power" + ',site=%s value=%s' % (site, wats), "energy_total" + ',site=%s value=%s' % (site, wat_hours)]
+
+
+def runDevice(kind, index, interval, stop, stats, server):
+    """Simulate one device, publish messages every interval seconds until stop is set.
+
+    :param kind: string esp or plug, plugs are simulated as one HS110/energyUsage.py collector each
+    :param index: int device number
+    :param interval: float seconds between publish cycles
+    :param stop: threading.Event
+    :param stats: dictionary with shared counters
+    :param server: string MQTT server IP
+    """
+    site = "loadtest-%s-%02d" % (kind, index)
+    client = mqtt.Client(client_id=site)
+    client.connect(server)
+    client.loop_start()
+
+    tank = random.uniform(40, 60)
+    wat_hours = 0.0
+    next_run = time.monotonic() + random.uniform(0, interval)  # spread devices over interval
+
+    while not stop.is_set():
+        stop.wait(max(0.0, next_run - time.monotonic()))
+        if stop.is_set():
+            break
+        next_run += interval
+
+        if kind == 'esp':
+            tank += random.uniform(-0.2, 0.1)
+            msgs = espPayloads(site, {'pipe': tank - random.uniform(5, 15), 'tank': tank})
+        else:
+            wats = random.choice([0.0, 2400.0])
+            wat_hours += wats * interval / 3600
+            msgs = ['\n'.join(plugPayloads(site, wats, round(wat_hours, 3)))]  # collector publishes one message
+
+        for msg in msgs:
+            info = client.publish(topic=mqttPublishTopic, payload=msg)
+            with stats['lock']:
+                stats['published'] += msg.count(b'\n' if isinstance(msg, bytes) else '\n') + 1  # records
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    stats['publish_errors'] += 1
+
+    client.loop_stop()
+    client.disconnect()
+
+
+# Measurements
+def runProbe(db, server, interval, stop, latencies):
+    """Publish probe messages with sequence number and wait till they are queryable from Influxdb,
+    store end to end ingest latency in seconds(None when probe didn't arrive in 60 seconds).
+
+    :param db: InfluxDBClient object
+    :param server: string MQTT server IP
+    :param interval: float seconds between probes
+    :param stop: threading.Event
+    :param latencies: list for results
+    """
+    client = mqtt.Client(client_id='loadtest-probe')
+    client.connect(server)
+    client.loop_start()
+    seq = int(time.time())
+
+    while not stop.is_set():
+        seq += 1
+        sent = time.monotonic()
+        client.publish(topic=mqttPublishTopic, payload=probeMeasurement + ',site=probe value=%s' % seq)
+
+        latency = None
+        while time.monotonic() - sent < 60:
+            res = db.query('SELECT count("value") FROM %s WHERE "value" = $seq' % probeMeasurement,
+                           bind_params={'seq': seq})
+            if next(res.get_points(), None):
+                latency = time.monotonic() - sent
+                break
+            time.sleep(0.2)
+
+        latencies.append(latency)
+        stop.wait(interval)
+
+    client.loop_stop()
+    client.disconnect()
+
+
+def runControllerQueries(db, interval, stop, latencies):
+    """Run the same queries as control algorithm and store their latency in seconds.
+
+    :param db: InfluxDBClient object
+    :param interval: float seconds between query rounds
+    :param stop: threading.Event
+    :param latencies: dictionary{query name: list for results}
+    """
+    day = str((datetime.now() - timedelta(days=7)).date())
+    date_val = {'start_time': day + 'T00:00:00Z', 'end_time': day + 'T23:59:59Z'}
+    queries = {
+        'day_pipe': ('SELECT "value" FROM temp_pipe WHERE time >= $start_time AND time <= $end_time', date_val),
+        'day_tank': ('SELECT "value" FROM temp_tank WHERE time >= $start_time AND time <= $end_time', date_val),
+        'latest_tank': ('SELECT last("value") FROM temp_tank', None),
+        'first_tank': ('SELECT first("value") FROM temp_tank', None),
+    }
+
+    while not stop.is_set():
+        for name, (q, params) in queries.items():
+            start = time.monotonic()
+            list(db.query(q, bind_params=params).get_points())
+            latencies.setdefault(name, []).append(time.monotonic() - start)
+        stop.wait(interval)
+
+
+def countStored(db, start_time):
+    """Count messages of simulated devices stored in Influxdb since start of test.
+
+    :param db: InfluxDBClient object
+    :param start_time: string RFC3339 time of test start
+    :return: int number of stored records
+    """
+    stored = 0
+    for measurement in ['temp_pipe', 'temp_tank', 'power', 'energy_total']:
+        res = db.query('SELECT count("value") FROM %s WHERE time >= $start_time AND site =~ /^loadtest-/'
+                       % measurement, bind_params={'start_time': start_time})
+        point = next(res.get_points(), None)
+        if point:
+            stored += int(point['count'])
+
+    return stored
+
+
+def cleanup(db):
+    """Drop series of simulated devices and probe measurement, so they don't affect controller.
+
+    :param db: InfluxDBClient object
+    """
+    db.query('DROP SERIES WHERE "site" =~ /^loadtest-/')
+    db.query('DROP MEASUREMENT %s' % probeMeasurement)
+
+
+def summary(values):
+    """Format latency list as string with percentiles in milliseconds.
+
+    :param values: list of float seconds
+    :return: string
+    """
+    if not values:
+        return "no data"
+    v = np.array(values) * 1000
+
+    return "n=%d p50=%.1f ms p95=%.1f ms max=%.1f ms" % (len(v), np.percentile(v, 50), np.percentile(v, 95), v.max())
+
+
+def run(args):
+    """Start simulated devices and measurements, wait for test duration and print results.
+
+    :param args: parsed command line arguments
+    """
+    db = influxdb.InfluxDBClient(host=args.influx, port=8086, username='telegraf', password='telegraf',
+                                 database='sensors')
+    stop = threading.Event()
+    stats = {'lock': threading.Lock(), 'published': 0, 'publish_errors': 0}
+    ingest = []
+    queries = {}
+    start_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    threads = [threading.Thread(target=runDevice, args=('esp', i + 1, args.esp_interval, stop, stats, args.mqtt))
+               for i in range(args.nodes)]
+    threads += [threading.Thread(target=runDevice, args=('plug', i + 1, args.plug_interval, stop, stats, args.mqtt))
+                for i in range(args.plugs)]
+    threads.append(threading.Thread(target=runProbe, args=(db, args.mqtt, args.probe_interval, stop, ingest)))
+    threads.append(threading.Thread(target=runControllerQueries, args=(db, args.query_interval, stop, queries)))
+
+    for t in threads:
+        t.start()
+
+    try:
+        print("Running %d ESP nodes and %d plugs for %d s..." % (args.nodes, args.plugs, args.duration))
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+
+        time.sleep(args.settle)  # let Telegraf flush its buffer
+        stored = countStored(db, start_time)
+    finally:   # also when test is interrupted
+        stop.set()
+        for t in threads:
+            t.join()
+        if not args.keep_data:
+            cleanup(db)
+
+    published = stats['published']
+    lost_probes = sum(1 for latency in ingest if latency is None)
+
+    print("Published: %d, publish errors: %d, stored: %d, dropped: %d (%.2f %%)"
+          % (published, stats['publish_errors'], stored, published - stored,
+             100 * (published - stored) / published if published else 0))
+    print("Ingest latency: %s, lost probes: %d" % (summary([x for x in ingest if x is not None]), lost_probes))
+    for name, values in queries.items():
+        print("Query %s: %s" % (name, summary(values)))
+
+
+# ===================================== #
+#                 MAIN                  #
+# ===================================== #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SmartBoiler server load test")
+    parser.add_argument('--nodes', type=int, default=10, help="number of simulated ESP nodes")
+    parser.add_argument('--plugs', type=int, default=10, help="number of simulated HS110 plugs")
+    parser.add_argument('--esp-interval', type=float, default=5, help="seconds between ESP publish cycles")
+    parser.add_argument('--plug-interval', type=float, default=5, help="seconds between plug publish cycles")
+    parser.add_argument('--probe-interval', type=float, default=5, help="seconds between ingest latency probes")
+    parser.add_argument('--query-interval', type=float, default=10, help="seconds between controller query rounds")
+    parser.add_argument('--duration', type=int, default=60, help="test duration in seconds")
+    parser.add_argument('--settle', type=int, default=20, help="seconds to wait for Telegraf flush after test")
+    parser.add_argument('--mqtt', default='localhost', help="MQTT server IP")
+    parser.add_argument('--influx', default='localhost', help="Influxdb server IP")
+    parser.add_argument('--keep-data', action='store_true', help="don't drop simulated records after test")
+
+    run(parser.parse_args())
@@ -0,0 +1,144 @@
+"""
+Bridge between compact binary sensor frames published by ESP8266/main.py and Influxdb. Frames received from MQTT
+server are collected and every flush interval decoded in one batch and stored as line protocol, in the same
+measurements as text messages stored by Telegraf.
+
+Frame format(little endian): uint8 magic 0xB1, uint8 version 1, uint8 readings count, followed by readings
+of uint8 sensor id(0 pipe, 1 tank), uint32 seconds since 2000-01-01 UTC, int16 temperature in 0.01 deg of C.
+
+author: J.Mitura (xmitur01)
+version: 1.0
+"""
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+frameMagic = 0xB1
+frameVersion = 1
+frameHeader = struct.Struct('<BBB')
+readingDtype = np.dtype([('sensor', '<u1'), ('time', '<u4'), ('temp', '<i2')])  # packed, 7 bytes
+epochOffset = 946684800  # seconds between 1970-01-01 and 2000-01-01(MicroPython epoch)
+sensorNames = np.array(["pipe", "tank"])
+
+
+def decodeFrames(frames):
+    """Decode batch of binary frames to arrays. Frames with unknown header or wrong length are skipped.
+
+    :param frames: list of bytes frames
+    :return: tuple[array sensor ids, array epoch seconds, array temperatures in deg of C]
+    """
+    parts = []
+    for frame in frames:
+        if len(frame) < frameHeader.size:
+            continue
+        magic, version, count = frameHeader.unpack_from(frame)
+        size = frameHeader.size + count * readingDtype.itemsize
+        if magic != frameMagic or version != frameVersion or len(frame) < size:
+            continue
+        parts.append(np.frombuffer(frame, dtype=readingDtype, count=count, offset=frameHeader.size))
+
+    if not parts:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    readings = np.concatenate(parts)
+
+    return readings['sensor'], readings['time'].astype(np.int64) + epochOffset, readings['temp'] / 100
+
+
+def toLineProtocol(sensors, times, temps):
+    """Convert decoded readings to line protocol records with the same names and tags as ESP text messages.
+
+    :param sensors: array sensor ids
+    :param times: array epoch seconds
+    :param temps: array temperatures in deg of C
+    :return: list of strings
+    """
+    sites = sensorNames[np.clip(sensors, 0, len(sensorNames) - 1)]
+    names = np.where(sites == "pipe", "temp_pipe", "temp_tank")
+
+    return ['%s,site=%s value=%s %d' % (n, s, round(v, 2), t)
+            for n, s, v, t in zip(names.tolist(), sites.tolist(), temps.tolist(), times.tolist())]
+
+
+def onMessage(client, userdata, message):
+    """MQTT client callback, store received frame for next flush.
+
+    :param client: MQTT client object
+    :param userdata: user data set for MQTT client
+    :param message: MQTT message object
+    """
+    with lock:
+        pending.append(bytes(message.payload))
+
+
+def onConnect(client, userdata, flags, rc):
+    """MQTT client callback, subscribes to binary frames after every (re)connection, broker doesn't keep
+    subscriptions of clean session.
+
+    :param client: MQTT client object
+    :param userdata: user data set for MQTT client
+    :param flags: dictionary of response flags sent by broker
+    :param rc: int connection result, 0 when successful
+    """
+    if rc == 0:
+        client.subscribe(mqttBinaryTopic)
+        print("Connected to %s MQTT broker" % mqttServerIP)
+    else:
+        print("Failed to connect to MQTT broker, result code %s." % rc)
+
+
+def flush():
+    """Decode collected frames and write them to Influxdb. When write fails frames are returned to pending ones
+    and written with next flush, the oldest are dropped over maxPendingFrames.
+
+    :return: int number of stored readings
+    """
+    global pending
+
+    with lock:
+        frames, pending = pending, []
+
+    lines = toLineProtocol(*decodeFrames(frames))
+    if lines:
+        try:
+            db.write_points(lines, protocol='line', time_precision='s')
+        except Exception as e:
+            print("Failed to write %d readings to Influxdb: %r" % (len(lines), e))
+            with lock:
+                pending = (frames + pending)[-maxPendingFrames:]
+            return 0
+
+    return len(lines)
+
+
+# ===================================== #
+#                 MAIN                  #
+# ===================================== #
+
+mqttBinaryTopic = 'sensors/bin'
+mqttServerIP = '192.168.1.105'  # change to Your MQTT IP
+flushInterval = 10  # [s]
+maxPendingFrames = 100000  # frames kept while Influxdb is down, about a month of one ESP node
+
+pending = []
+lock = threading.Lock()
+
+if __name__ == '__main__':
+    import influxdb
+    import paho.mqtt.client as mqtt
+
+    db = influxdb.InfluxDBClient(host='localhost', port=8086, username='telegraf', password='telegraf',
+                                 database='sensors')
+
+    mqttClient = mqtt.Client(client_id='sensorBridge')
+    mqttClient.on_connect = onConnect
+    mqttClient.on_message = onMessage
+    mqttClient.connect_async(mqttServerIP)
+    mqttClient.loop_start()
+
+    while True:
+        time.sleep(flushInterval)
+        flush()